@@ -0,0 +1,151 @@
+import hashlib
+import os
+import pygame
+
+
+def adjust_surf_brightness(surf, light_level, max_level):
+    """Return copy of surf dimmed to given light level."""
+    alpha = int(255 * (1 - light_level / float(max_level)))
+    surf = surf.copy()
+    shade_surf = pygame.Surface(surf.get_size(), pygame.SRCALPHA, 32)
+    (width, height) = shade_surf.get_size()
+    pygame.draw.rect(shade_surf, (0, 0, 0, alpha), (0, 0, width, height))
+    surf.blit(shade_surf, (0, 0))
+    return surf
+
+
+class LitSurfaces:
+    """Lists of an image dimmed to every light level, loaded when first used.
+
+    Indexing by key returns the list of surfaces for that key's image, indexed
+    by light level. The first time an image is used, its dimmed copies are
+    loaded from an atlas in cache_dir, which is a row of them saved as a PNG
+    named after a hash of the image file. If there isn't one yet, the copies
+    are made and the atlas is saved for next time.
+
+    If the display has been set up, the surfaces are converted to its pixel
+    format.
+    """
+    VERSION = "1" # change to rebuild the atlases when dimming changes
+
+    def __init__(self, filenames, max_level, cache_dir):
+        """Load images from a dict of key -> image filename when used."""
+        self.filenames = filenames
+        self.max_level = max_level
+        self.cache_dir = cache_dir
+        self._surfs = {} # key -> list of surfaces by light level
+
+    def __getitem__(self, key):
+        """Return the list of surfaces by light level for key's image."""
+        try:
+            return self._surfs[key]
+        except KeyError:
+            self._surfs[key] = self._load(self.filenames[key])
+            return self._surfs[key]
+
+    def __len__(self):
+        """Return the number of images."""
+        return len(self.filenames)
+
+    def _load(self, filename):
+        """Return the list of surfaces by light level for an image file."""
+        with open(filename, "rb") as f:
+            digest = hashlib.sha1(f.read())
+        digest.update("%s %i" % (self.VERSION, self.max_level))
+        atlas_path = os.path.join(self.cache_dir, digest.hexdigest() + ".png")
+        if os.path.exists(atlas_path):
+            atlas = pygame.image.load(atlas_path)
+        else:
+            print "building lit surfaces for %s..." % filename
+            atlas = self._make_atlas(pygame.image.load(filename))
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            pygame.image.save(atlas, atlas_path)
+        if pygame.display.get_surface() != None:
+            atlas = atlas.convert_alpha()
+        (width, height) = (atlas.get_width() / (self.max_level + 1),
+                           atlas.get_height())
+        return [atlas.subsurface((level * width, 0, width, height))
+                for level in xrange(self.max_level + 1)]
+
+    def _make_atlas(self, surf):
+        """Return a row of copies of surf at every light level."""
+        (width, height) = surf.get_size()
+        atlas = pygame.Surface((width * (self.max_level + 1), height),
+                               pygame.SRCALPHA, 32)
+        for level in xrange(self.max_level + 1):
+            lit_surf = adjust_surf_brightness(surf, level, self.max_level)
+            # copy pixels including alpha instead of blending
+            atlas.blit(lit_surf, (level * width, 0),
+                       special_flags=pygame.BLEND_RGBA_MAX)
+        return atlas
+
+
+class TextureAtlas:
+    """All the surfaces of a LitSurfaces packed into one surface.
+
+    Each image gets a column of the atlas, with a row for each light level.
+    Drawing many tiles from one surface lets a whole batch go through a single
+    Surface.blits call, using the precomputed source rects. The atlas is built
+    the first time it is used.
+    """
+    def __init__(self, lit_surfs):
+        """Create an atlas of the images of lit_surfs."""
+        self.lit_surfs = lit_surfs
+        self._surf = None
+        self._rects = None
+
+    def get(self):
+        """Return (surface, rects) of the atlas.
+
+        rects[key][light_level] is the area of the surface holding the image
+        for key at that light level.
+        """
+        if self._surf == None:
+            self._build()
+        return (self._surf, self._rects)
+
+    def _build(self):
+        """Pack the surfaces of every image into the atlas."""
+        keys = sorted(self.lit_surfs.filenames)
+        levels = self.lit_surfs.max_level + 1
+        (width, height) = self.lit_surfs[keys[0]][0].get_size()
+        atlas = pygame.Surface((width * len(keys), height * levels),
+                               pygame.SRCALPHA, 32)
+        self._rects = {}
+        for (column, key) in enumerate(keys):
+            self._rects[key] = []
+            for (level, surf) in enumerate(self.lit_surfs[key]):
+                rect = (column * width, level * height, width, height)
+                # copy pixels including alpha instead of blending
+                atlas.blit(surf, rect, special_flags=pygame.BLEND_RGBA_MAX)
+                self._rects[key].append(rect)
+        if pygame.display.get_surface() != None:
+            atlas = atlas.convert_alpha()
+        self._surf = atlas
+
+
+class Sprites:
+    """Images loaded from files the first time they're used and then shared.
+
+    Indexing by filename returns the image's surface, so everything drawing
+    the same image uses one surface instead of loading its own copy. If the
+    display has been set up, the surfaces are converted to its pixel format.
+    """
+    def __init__(self):
+        """Create an empty cache."""
+        self._surfs = {} # filename -> surface
+
+    def __getitem__(self, filename):
+        """Return the surface for an image file."""
+        try:
+            return self._surfs[filename]
+        except KeyError:
+            surf = pygame.image.load(filename)
+            if pygame.display.get_surface() != None:
+                surf = surf.convert_alpha()
+            self._surfs[filename] = surf
+            return surf
+
+
+SPRITES = Sprites()
@@ -0,0 +1,62 @@
+import heapq
+from time import time
+
+
+class BlockTicks:
+    """A queue of blocks waiting to be ticked at a later time.
+
+    Blocks are scheduled with a delay in ms, and go in a bucket for each
+    BUCKET_TIME ms, so blocks due at about the same time are ticked together
+    and the queue is only ordered by bucket. Each block is only in the queue
+    once, and scheduling a block which is already waiting does nothing.
+
+    tick_func(x, y) is called for each block when it's due, which may
+    schedule it again. Blocks which can't be ticked within the time budget
+    of an update are ticked in the next one.
+    """
+    BUCKET_TIME = 100 # ms
+
+    def __init__(self, tick_func):
+        """Create an empty queue calling tick_func for due blocks."""
+        self.tick_func = tick_func
+        self.time = 0.0 # ms of updates so far
+        self._buckets = {} # bucket number -> list of blocks
+        self._bucket_heap = [] # bucket numbers, in a heap
+        self._scheduled = set() # blocks in a bucket
+
+        self.ticks = 0 # blocks ticked so far
+
+    def __len__(self):
+        """Return the number of blocks waiting."""
+        return len(self._scheduled)
+
+    def is_scheduled(self, block):
+        """Return True if the (x, y) block is waiting to be ticked."""
+        return block in self._scheduled
+
+    def schedule(self, block, delay):
+        """Tick the (x, y) block after delay ms, unless it's waiting."""
+        if block in self._scheduled:
+            return
+        self._scheduled.add(block)
+        bucket = int((self.time + delay) / self.BUCKET_TIME)
+        if bucket not in self._buckets:
+            self._buckets[bucket] = []
+            heapq.heappush(self._bucket_heap, bucket)
+        self._buckets[bucket].append(block)
+
+    def update(self, millis, budget):
+        """Tick the blocks which are due for up to budget ms."""
+        self.time += millis
+        deadline = time() + budget / 1000.0
+        now_bucket = int(self.time / self.BUCKET_TIME)
+        while self._bucket_heap and self._bucket_heap[0] <= now_bucket:
+            blocks = self._buckets[self._bucket_heap[0]]
+            while blocks:
+                if time() > deadline:
+                    return
+                block = blocks.pop()
+                self._scheduled.discard(block)
+                self.tick_func(*block)
+                self.ticks += 1
+            del self._buckets[heapq.heappop(self._bucket_heap)]
@@ -1,40 +1,26 @@
-import pygame
+from assets import LitSurfaces, TextureAtlas
 
 # TODO: this also exists in light.py
 MAX_LIGHT_LEVEL = 15
 
-def adjust_surf_brightness(surf, light_level, max_level):
-    """Return copy of surf dimmed to given light level."""
-    alpha = int(255 * (1 - light_level / float(max_level)))
-    surf = surf.copy()
-    shade_surf = pygame.Surface(surf.get_size(), pygame.SRCALPHA)
-    (width, height) = shade_surf.get_size()
-    pygame.draw.rect(shade_surf, (0, 0, 0, alpha), (0, 0, width, height))
-    surf.blit(shade_surf, (0, 0))
-    return surf
+# directory for lit block surfaces saved by LitSurfaces
+ASSET_CACHE_DIR = "cache"
 
 
 class Block:
     """Class to provide info about block ID as attributes.
     
-    The first time it is imported, this module will load the surfaces.
+    Block surfaces are loaded the first time they are used.
+
+    Hot paths should use the shared instances in BLOCKS, or the property
+    tables below the class, instead of creating new Blocks.
     """
-    # shortcut to load light-level-index array of block surfaces
-    def l(surf_filename):
-        surf = pygame.image.load(surf_filename)
-        lit_surfs = []
-        for light_level in xrange(MAX_LIGHT_LEVEL + 1):
-            lit_surfs.append(adjust_surf_brightness(surf, light_level,
-                             MAX_LIGHT_LEVEL))
-        return lit_surfs
-    
-    print "loading block surfaces..."
-    #       block_id  name     solid  surf             brightness opacity
-    info = {0:       ("air",   False, l("air.png"),    0,          1),
-            1:       ("grass", True,  l("grass.png"),  0,          5),
-            2:       ("rock",  True,  l("rock.png"),   0,          5),
-            3:       ("lamp",  True,  l("lamp.png"),   15,         1),
-            4:       ("dirt",  True,  l("dirt.png"),   0,          5),
+    #       block_id  name     solid  surf          brightness opacity
+    info = {0:       ("air",   False, "air.png",    0,          1),
+            1:       ("grass", True,  "grass.png",  0,          5),
+            2:       ("rock",  True,  "rock.png",   0,          5),
+            3:       ("lamp",  True,  "lamp.png",   15,         1),
+            4:       ("dirt",  True,  "dirt.png",   0,          5),
            }
     # derive name->id dict
     names = {}
@@ -55,11 +41,32 @@ class Block:
         
         self.name = bi[0]
         self.is_solid = bi[1]
-        self.surf = bi[2][MAX_LIGHT_LEVEL]
-        self.lit_surfs = bi[2]
         self.brightness = bi[3]
         self.opacity = bi[4]
 
+    @property
+    def lit_surfs(self):
+        """Light-level-indexed list of this block's surfaces."""
+        return LIT_SURFS[self.id]
+
+    @property
+    def surf(self):
+        """This block's surface at full brightness."""
+        return LIT_SURFS[self.id][MAX_LIGHT_LEVEL]
+
+
+# one shared Block per block id
+BLOCKS = tuple(Block(bid) for bid in xrange(len(Block.info)))
+
+# block properties indexed by block id
+IS_SOLID = tuple(block.is_solid for block in BLOCKS)
+OPACITY = tuple(block.opacity for block in BLOCKS)
+BRIGHTNESS = tuple(block.brightness for block in BLOCKS)
+LIT_SURFS = LitSurfaces(dict((bid, Block.info[bid][2]) for bid in Block.info),
+                        MAX_LIGHT_LEVEL, ASSET_CACHE_DIR)
+# all of LIT_SURFS in one surface, for drawing many tiles at once
+BLOCK_ATLAS = TextureAtlas(LIT_SURFS)
+
 
 if __name__ == "__main__":
     print Block(0).name
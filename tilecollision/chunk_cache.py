@@ -0,0 +1,134 @@
+import pygame
+from collections import OrderedDict
+
+
+class ChunkCache:
+    """A memory-limited cache of same-sized surfaces rendered for chunks.
+
+    Surfaces are kept in least recently used order. When the cache is over its
+    memory budget, the least recently used surfaces are evicted, except for
+    ones used since the last call to start_frame, since those are on screen.
+
+    Invalidated and evicted surfaces are kept on a free list and reused by
+    new_surface instead of allocating new ones. Free surfaces count towards
+    the budget, and are dropped before any cached surfaces are evicted.
+
+    The hits, misses, evictions and allocations attributes count what the
+    cache has done, to help tune the budget.
+    """
+    def __init__(self, surf_size, budget, flags=0, depth=0):
+        """Create a cache for surfaces of surf_size using budget bytes.
+
+        flags and depth are used to create new surfaces.
+        """
+        self.surf_size = surf_size
+        self.budget = budget
+        self.flags = flags
+        self.depth = depth
+        self._surfs = OrderedDict() # chunk pos -> surface, oldest first
+        self._free = [] # surfaces available for reuse
+        self._frame = 0
+        self._last_used = {} # chunk pos -> frame it was last used in
+        self._surf_bytes = None # size of one surface
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.allocations = 0
+
+    def __contains__(self, pos):
+        """Return True if a surface is cached for the chunk at pos."""
+        return pos in self._surfs
+
+    def __len__(self):
+        """Return the number of cached surfaces."""
+        return len(self._surfs)
+
+    def start_frame(self):
+        """Mark the start of a frame, after which unused surfaces may go."""
+        self._frame += 1
+
+    def get(self, pos):
+        """Return the surface cached for the chunk at pos, or None."""
+        surf = self._surfs.pop(pos, None)
+        if surf == None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._surfs[pos] = surf # move to most recently used
+        self._last_used[pos] = self._frame
+        return surf
+
+    def new_surface(self):
+        """Return a surface to render into, reused if possible.
+
+        If there are no free surfaces and the cache is full, the least recently
+        used surface is evicted and reused. The contents of a reused surface
+        are undefined.
+        """
+        if (not self._free and self._surf_bytes != None and
+                self.get_memory() + self._surf_bytes > self.budget):
+            self._evict_lru()
+        if self._free:
+            return self._free.pop()
+        self.allocations += 1
+        if self.depth:
+            surf = pygame.Surface(self.surf_size, self.flags, self.depth)
+        else:
+            surf = pygame.Surface(self.surf_size, self.flags)
+        if self._surf_bytes == None:
+            self._surf_bytes = (surf.get_bytesize() * self.surf_size[0] *
+                                self.surf_size[1])
+        return surf
+
+    def peek(self, pos):
+        """Return the surface cached for the chunk at pos, or None.
+
+        Unlike get, this doesn't count as a use of the surface.
+        """
+        return self._surfs.get(pos)
+
+    def put(self, pos, surf):
+        """Cache surf for the chunk at pos, then evict if over budget."""
+        if self._surfs.get(pos) is not surf:
+            self.discard(pos)
+        self._surfs.pop(pos, None)
+        self._surfs[pos] = surf
+        self._last_used[pos] = self._frame
+        self._evict()
+
+    def discard(self, pos):
+        """Invalidate the surface for the chunk at pos, if any."""
+        surf = self._surfs.pop(pos, None)
+        if surf != None:
+            del self._last_used[pos]
+            self._free.append(surf)
+
+    def get_memory(self):
+        """Return the number of bytes used by cached and free surfaces."""
+        if self._surf_bytes == None:
+            return 0
+        return self._surf_bytes * (len(self._surfs) + len(self._free))
+
+    def _evict(self):
+        """Evict least recently used surfaces until within budget."""
+        while self.get_memory() > self.budget:
+            if self._free:
+                # free surfaces are the first to go
+                self._free.pop()
+            elif not self._evict_lru():
+                break
+
+    def _evict_lru(self):
+        """Move the least recently used surface to the free list.
+
+        Return False if it is on screen, so nothing could be evicted.
+        """
+        if not self._surfs:
+            return False
+        pos = next(iter(self._surfs))
+        if self._last_used[pos] == self._frame:
+            return False # everything else is on screen too
+        self.discard(pos)
+        self.evictions += 1
+        return True
@@ -0,0 +1,38 @@
+from grid import UniformGrid
+
+
+class Chunk:
+    """Block ids and light levels for a square area of the map.
+
+    Chunks at the right and bottom edges of the map may be smaller than the
+    others.
+
+    When all of a chunk's blocks or light levels are the same, they are stored
+    as a UniformGrid, until set_block or set_light changes one of them.
+    """
+    def __init__(self, pos, blocks):
+        """Create a chunk with topleft block at pos from a Grid of block ids.
+
+        Light levels start at 0.
+        """
+        self.pos = pos
+        self.size = blocks.size
+        self.blocks = blocks.compact()
+        self.light = UniformGrid(self.size, 0)
+        self.dirty = False # True if blocks changed since generating the chunk
+
+    def set_block(self, x, y, block_id):
+        """Set the block at (x, y) relative to the chunk's topleft."""
+        if self.blocks.get_uniform() == block_id:
+            return
+        if self.blocks.get_uniform() != None:
+            self.blocks = self.blocks.expand()
+        self.blocks.set(x, y, block_id)
+
+    def set_light(self, x, y, light_level):
+        """Set the light level at (x, y) relative to the chunk's topleft."""
+        if self.light.get_uniform() == light_level:
+            return
+        if self.light.get_uniform() != None:
+            self.light = self.light.expand()
+        self.light.set(x, y, light_level)
@@ -1,55 +1,74 @@
+import numpy
 import pygame
-from random import uniform, randrange
-from math import ceil, floor, sin, cos, atan2, sqrt, pow
+from random import uniform
+from math import ceil, sin, cos, atan2, sqrt, pow
+from multiprocessing import cpu_count
+from time import time
 
 import map_generation
 import particles
-from blocks import Block
+from assets import SPRITES
+from block_ticks import BlockTicks
+from blocks import Block, BLOCKS, BLOCK_ATLAS, IS_SOLID
+from chunk_cache import ChunkCache
+from chunks import Chunk
+from grid import Grid
 from hud import HUD
-from light import Light
+from light import Light, LightSource, SolidColumns
+from occupancy import SolidRows
+from physics import EntityPhysics
+from rasterizer import ChunkRasterizer
+from region import RegionStore
+from render_scheduler import RenderScheduler
+from spatial import ChunkIndex
+from viewport import Viewport
 
 class MapEntity:
     """Something that can be drawn on and collide with the map.
     
+    The entity's position, size, velocity and controls are stored in a row of
+    an EntityPhysics, which moves all the entities of a map together. The
+    names of its FIELDS can be used as attributes of the entity, which read
+    and write that row.
+    
     For now there's player-specific code in here.
     """
-    def __init__(self, x, y, w, h, dx, dy):
-        """Create entity with given position, size, and velocity."""
-        self.x = x
-        self.y = y
-        self.width = w
-        self.height = h
-        self.dx = dx # block/sec
-        self.dy = dy # block/sec
-        
-        self.is_falling = True # whether the entity is in the air
-        
-        self.grav_a = 5.0 # blocks/sec/sec
-        self.max_fall = 10.0 # block/sec
-        self.jump_v = -4.5 # block/sec
-        self.walk_a = 6.0 # blocks/sec/sec
-        self.max_walk = 6.0 # block/sec
-        
-        # actions entity can be trying to do
-        self.walk_left = False
-        self.walk_right = False
-        self.jump = False
-        
-        self.normal_surf = pygame.image.load('player_normal.png')
-        self.falling_surf = pygame.image.load('player_falling.png')
-        
-        self.fist_surf = pygame.image.load('fist.png')
+    def __init__(self, physics, **values):
+        """Create entity in an EntityPhysics with field values by keyword."""
+        self.physics = physics
+        self.index = None # row in physics, set by physics.add
+        physics.add(self, **values)
+        
+        self.light_source = None # LightSource carried by the entity, if any
+        
         self.PUNCH_LENGTH = 250 # ms
-        self.punch_time = self.PUNCH_LENGTH # ms
+        self.punch_start = None # physics time of the last punch
         self.punch_angle = 0 # degrees
+    
+    def __getattr__(self, name):
+        """Return the value of a physics field."""
+        if name in EntityPhysics.FIELDS:
+            return self.physics.get(self.index, name)
+        raise AttributeError(name)
+    
+    def __setattr__(self, name, value):
+        """Set a physics field, or an ordinary attribute."""
+        if name in EntityPhysics.FIELDS:
+            self.physics.set(self.index, name, value)
+        else:
+            self.__dict__[name] = value
         
     def get_rect(self):
         """Return collision box rect."""
         return (self.x, self.y, self.width, self.height)
     
+    def get_center(self):
+        """Return grid position of the center of the entity."""
+        return (self.x + self.width / 2, self.y + self.height / 2)
+    
     def punch(self, angle):
         """Activate the punch animation toward the given angle."""
-        self.punch_time = 0
+        self.punch_start = self.physics.time
         self.punch_angle = angle
     
     def draw(self, px, py, pw, ph, surf):
@@ -58,13 +77,15 @@ class MapEntity:
         This is called by Map to draw this entity to the given location.
         """
         # draw fist animation
-        if self.punch_time != self.PUNCH_LENGTH:
-            prog = self.punch_time / self.PUNCH_LENGTH
+        if (self.punch_start != None and 
+                self.physics.time - self.punch_start < self.PUNCH_LENGTH):
+            fist_surf = SPRITES["fist.png"]
+            prog = (self.physics.time - self.punch_start) / self.PUNCH_LENGTH
             extension = 1 - pow(prog-0.5,2) * 4
-            extension_length = extension * self.fist_surf.get_size()[1]
+            extension_length = extension * fist_surf.get_size()[1]
             ext_x = extension_length * sin((3.141/180)*self.punch_angle)
             ext_y = extension_length * cos((3.141/180)*self.punch_angle)
-            surf_rot = pygame.transform.rotate(self.fist_surf, 
+            surf_rot = pygame.transform.rotate(fist_surf, 
                                                180+self.punch_angle)
             fist_size = surf_rot.get_size()
             #TODO: center the fist properly
@@ -72,104 +93,10 @@ class MapEntity:
                                  py + ext_y))
         
         # draw body
-        e_surf = self.falling_surf if self.is_falling else self.normal_surf
-        surf.blit(e_surf, (px, py))
-    
-    def update(self, millis, map):
-        """Update the physics of this entity and resolve collisions.
-        
-        This is where the guts of the collision resolution is. If the next
-        position will cause a collision, then try moving only in the x or y
-        component before giving up. If there is a collision, snap to the 
-        next grid point in that direction.
-        """
-        # update punch animation
-        self.punch_time += millis
-        if self.punch_time > self.PUNCH_LENGTH:
-            self.punch_time = self.PUNCH_LENGTH
-        
-        # apply gravity
-        if (self.is_falling):
-            self.dy += (self.grav_a * millis/1000)
-            if (self.dy > self.max_fall):
-                self.dy = self.max_fall
-        else:
-            self.dy = 0.01 # have to keep some small dy so we can start falling
-        
-        # apply jumping
-        if (not self.is_falling and self.jump):
-            self.dy = self.jump_v
-            self.is_falling = True
-        
-        # apply walking
-        if (self.walk_right and not self.walk_left):
-            self.dx += (self.walk_a * millis/1000)
-            if abs(self.dx) > self.max_walk:
-                self.dx = self.max_walk
-        elif (self.walk_left and not self.walk_right):
-            self.dx -= (self.walk_a * millis/1000)
-            if abs(self.dx) > self.max_walk:
-                self.dx = -1 * self.max_walk
-        else:
-            self.dx = 0 # stop instantly?
-        
-        # new x and y components
-        new_x = self.x + (self.dx * millis/1000)
-        new_y = self.y + (self.dy * millis/1000)
-        
-        # next position using given next components
-        next_xy = (new_x, new_y, self.width, self.height)
-        next_y = (self.x, new_y, self.width, self.height)
-        next_x = (new_x, self.y, self.width, self.height)
-        
-        y_increasing = (new_y > self.y) # entity is falling
-        y_decreasing = (new_y < self.y) # entity is ascending
-        y_collision = False
-        y_snap_dir = 1 if y_increasing else -1
-        x_snap_dir = 1 if (new_x > self.x) else -1
-        
-        if not map.rect_colliding(next_xy):
-            # no collision, so move to next position
-            self.x = new_x
-            self.y = new_y
+        if self.is_falling:
+            surf.blit(SPRITES["player_falling.png"], (px, py))
         else:
-            # collision, so try moving in x or y only
-            if not map.rect_colliding(next_x):
-                # moving in x is fine
-                self.x = new_x
-                y_collision = True
-                self.snap_edge_to_grid(0, y_snap_dir)
-            elif not map.rect_colliding(next_y):
-                # moving in y is fine
-                self.y = new_y
-                self.snap_edge_to_grid(x_snap_dir, 0)
-            else:
-                # can't move
-                y_collision = True
-                self.snap_edge_to_grid(x_snap_dir, y_snap_dir)
-                
-        if (y_increasing and not y_collision):
-            self.is_falling = True
-        if (y_increasing and y_collision):
-            self.is_falling = False
-        if (y_decreasing and y_collision):
-            # bumped head, so loose vertical velocity
-            self.dy = 0
-    
-    def snap_edge_to_grid(self, x_dir, y_dir):
-        """Move this entity to snap the specified edges to the grid."""
-        if x_dir == 1:
-            # snap right edge of entity to grid line
-            self.x += ceil(self.x + self.width) - (self.x + self.width)
-        elif x_dir == -1:
-            # snap left edge of entity to grid line
-            self.x = floor(self.x)
-        if y_dir == 1:
-            # snap bottom edge of entity to grid line
-            self.y += ceil(self.y + self.height) - (self.y + self.height)
-        elif y_dir == -1:
-            # snap top edge of entity to grid line
-            self.y = floor(self.y)
+            surf.blit(SPRITES["player_normal.png"], (px, py))
 
 
 class Map:
@@ -177,69 +104,482 @@ class Map:
     
     The map is made of 1.0x1.0 blocks.
     
+    The blocks are stored in square chunks, which are generated when the 
+    player comes within LOAD_RADIUS of them and thrown away when the player is
+    further than UNLOAD_RADIUS. Since sunlight and grass depend on the blocks
+    above them, chunks are always loaded in strips covering the map height.
+    
+    If the map has a save directory, changed chunks are saved to region files
+    when they are unloaded or the map is saved, and loaded from there instead
+    of being generated. Otherwise strips with changed blocks are kept loaded.
+    
     The map is rendered in square chunks of blocks, which are cached as 
     surfaces to reduce the number of blits needed to draw the map. A chunk
     only needs to be redrawn when a block it contains is changed.
+    
+    With LIGHT_OVERLAY enabled, the cached chunks are drawn fully lit and the
+    lighting is drawn on top of them from a second cache of darkness overlays.
+    Each overlay is drawn from a tiny surface with one pixel per block, which
+    is scaled up to the size of the chunk (smoothly if SMOOTH_LIGHT is
+    enabled). A lighting change then only redraws the overlay, not the tiles.
+    
+    Each cache may use up to CHUNK_CACHE_BUDGET bytes, and evicts the least
+    recently drawn chunks when it's full.
+    
+    Only chunks which are on screen and not cached are rendered as soon as 
+    they're needed. Each frame, up to RENDER_BUDGET ms is spent re-rendering
+    changed chunks and rendering the chunks the player is moving towards.
+    
+    The cached chunks are composed in a Viewport backbuffer a chunk larger
+    than the screen on each side. Only chunks which were re-rendered and
+    parts newly scrolled into the backbuffer are drawn to it, and it's copied
+    to the screen in one blit. Chunks off screen are only drawn to it once
+    they have been rendered ahead of time.
     """
-    def __init__(self, size):
-        """Create map of size*size tiles."""
+    def __init__(self, size, seed=None, save_dir=None):
+        """Create map of size (width, height) tiles from a generator seed.
+        
+        If save_dir is given, the map is saved there. If a map was already
+        saved there, its size and seed are used instead of the given ones.
+        
+        No chunks are loaded until load_around is called.
+        """
         self.TILE_SIZE = 20 # pixels
         self.CHUNK_SIZE = 8 # blocks square
-        self.BLOCK_UPDATE_SIZE = (40, 40) # rect size around player in blocks
-        self.BLOCK_UPDATE_FREQ = 1000 # number of blocks to update per second
+        self.GRASS_TICK_DELAY = (0.5, 3.0) # range of sec before grass changes
+        self.BLOCK_TICK_BUDGET = 1 # ms per update for ticking blocks
+        self.DYNAMIC_LIGHT_BUDGET = 2 # ms per update for moving lights
+        self.LIGHT_OVERLAY = True # draw light separately from chunk tiles
+        self.SMOOTH_LIGHT = False # interpolate light overlays between blocks
+        self.LOAD_RADIUS = 48 # blocks from player to load chunks
+        self.UNLOAD_RADIUS = 64 # blocks from player to unload chunks
+        self.CHUNK_CACHE_BUDGET = 16 * 2**20 # bytes for each surface cache
+        self.RENDER_BUDGET = 4 # ms per frame for rendering chunks early
+        self.PREFETCH_TIME = 1.0 # sec of player movement to render ahead
+        self.RASTER_WORKERS = 2 # threads rendering chunks, 0 for draw_chunk
+        self.GENERATION_WORKERS = cpu_count() # processes generating strips
+        self.MAX_PATCH = 32 # changed blocks to redraw instead of whole chunk
+        self.BACKGROUND_COLOR = (100, 100, 255)
+        self.SIM_LOD = True # update entities far from the player less often
+        self.SIM_NEAR = 24 # blocks from player to update every time
+        self.SIM_FAR = 40 # blocks from player to update at all
+        self.SIM_FAR_STEP = 4 # updates per update of far entities
+        self.MAX_PARTICLES = 4096 # particles alive at once
+        
+        self.regions = None # RegionStore to save chunks to, if any
+        if save_dir != None:
+            self.regions = RegionStore(save_dir, self.CHUNK_SIZE)
+            info = self.regions.read_info()
+            if info != None:
+                (size, seed) = (tuple(info["size"]), info["seed"])
         
-        self._blocks = [] # block_ids of the map in row-major order
         self.size = size # (width, height) of the map in blocks
         self.entities = [] # list of MapEntities in the map
+        self.physics = EntityPhysics() # moves the entities
+        self.entity_index = ChunkIndex(self.CHUNK_SIZE) # entities by chunk
+        self._entity_chunks = None # chunk of each physics row when indexed
         
-        self._blocks = map_generation.generate_map(size)
+        self.generator = map_generation.MapGenerator(seed)
+        self._band_generator = None # generates strips, started when needed
+        if self.regions != None:
+            self.regions.write_info({"size": self.size, 
+                                     "seed": self.generator.seed})
+        self._chunks = {} # topleft block of chunk -> Chunk
+        self._loaded_strips = set() # x of each loaded strip of chunks
         
-        self._particle_systems = [] # (ParticleSystem, pos) tuples
+        # (ParticleSystem, pos) tuples by chunk
+        self._particle_systems = ChunkIndex(self.CHUNK_SIZE)
+        # particles in map pixels, which are grid positions times TILE_SIZE
+        self.particles = particles.ParticlePool(self.MAX_PARTICLES)
+        self._sim_ticks = 0 # number of updates so far
         
         self.cursor_pos = None # pixel coords or None
         
+        # grass blocks which may die or spread
+        self.block_ticks = BlockTicks(self.tick_block)
+        
+        self.solid_columns = SolidColumns(self)
+        self.solid_rows = SolidRows(self)
         self.light = Light(self)
         
-        # prime the chunk cache by rendering every chunk in the map
-        self._chunk_cache = {}
-        print "priming chunk cache..."
-        for chunk in self.get_chunks_in_rect(((0, 0) + self.size)):
-            s = pygame.Surface((self.CHUNK_SIZE * self.TILE_SIZE, 
-                                self.CHUNK_SIZE * self.TILE_SIZE))
-            self.draw_chunk(s, chunk)
-            self._chunk_cache[chunk] = s
-        print "cached %i chunks" % len(self._chunk_cache)
+        chunk_px = self.CHUNK_SIZE * self.TILE_SIZE
+        # 32-bit, so the rasterizer's RGB arrays can be copied in whatever the
+        # display depth is
+        self._chunk_cache = ChunkCache((chunk_px, chunk_px), 
+                                       self.CHUNK_CACHE_BUDGET, 0, 32)
+        
+        # light overlays have a margin of one block for smooth lighting
+        overlay_size = self.CHUNK_SIZE + 2
+        self._overlay_tiny = pygame.Surface((overlay_size, overlay_size), 
+                                            pygame.SRCALPHA, 32)
+        overlay_px = overlay_size * self.TILE_SIZE
+        self._overlay_cache = ChunkCache((overlay_px, overlay_px), 
+                                         self.CHUNK_CACHE_BUDGET, 
+                                         pygame.SRCALPHA, 32)
+        
+        if self.RASTER_WORKERS > 0:
+            rasterizer = ChunkRasterizer(self, self.RASTER_WORKERS)
+            self._chunk_renders = RenderScheduler(self._chunk_cache, 
+                                                  rasterizer.render, 
+                                                  rasterizer, 
+                                                  patch_func=self.patch_chunk,
+                                                  max_patch=self.MAX_PATCH)
+        else:
+            self._chunk_renders = RenderScheduler(self._chunk_cache, 
+                                                  self.draw_chunk, 
+                                                  patch_func=self.patch_chunk,
+                                                  max_patch=self.MAX_PATCH)
+        self._overlay_renders = RenderScheduler(
+                self._overlay_cache, self.draw_light_overlay, 
+                patch_func=self.patch_light_overlay, max_patch=self.MAX_PATCH)
+        self._viewport = Viewport(chunk_px, self.draw_buffer)
+        self._uniform_chunk_surfs = {} # block id -> drawn chunk of that block
+    
+    def add_entity(self, **values):
+        """Add and return a MapEntity with physics field values by keyword."""
+        entity = MapEntity(self.physics, **values)
+        self.entities.append(entity)
+        self.entity_index.move(entity, entity.get_center())
+        return entity
+    
+    def remove_entity(self, entity):
+        """Remove a MapEntity from the map."""
+        self.entities.remove(entity)
+        self.entity_index.remove(entity)
+        self.physics.remove(entity)
+        self._entity_chunks = None # rows have moved, so reindex them all
+    
+    def get_entities_in_radius(self, center, radius):
+        """Return a list of the entities with centers within radius of center.
+        """
+        entities = []
+        for entity in self.entity_index.in_radius(center, radius):
+            (x, y) = entity.get_center()
+            if (x - center[0]) ** 2 + (y - center[1]) ** 2 <= radius ** 2:
+                entities.append(entity)
+        return entities
+    
+    def add_particle_system(self, ps, pos):
+        """Add a ParticleSystem centered at grid pos."""
+        self._particle_systems.move((ps, pos), pos)
+    
+    def _index_entities(self):
+        """Move the entities which changed chunks to their new buckets."""
+        chunks = self.physics.get_chunks(self.CHUNK_SIZE)
+        rows = xrange(len(chunks[0]))
+        if self._entity_chunks != None:
+            # only rows which changed chunks or were added since last time
+            indexed = len(self._entity_chunks[0])
+            changed = ((chunks[0][:indexed] != self._entity_chunks[0]) | 
+                       (chunks[1][:indexed] != self._entity_chunks[1]))
+            rows = (list(numpy.flatnonzero(changed)) + 
+                    range(indexed, len(chunks[0])))
+        for row in rows:
+            entity = self.physics.entities[row]
+            self.entity_index.move(entity, entity.get_center())
+        self._entity_chunks = chunks
+    
+    def _get_sim_steps(self, chunk, center):
+        """Return how many updates to move a chunk's objects by this update.
+        
+        With SIM_LOD, chunks more than SIM_NEAR blocks from center are only
+        updated every SIM_FAR_STEP updates, by that many updates at once, and
+        chunks more than SIM_FAR blocks away aren't updated. chunk may be
+        arrays of chunk positions, to get an array of steps.
+        """
+        if not self.SIM_LOD:
+            return 1
+        half = self.CHUNK_SIZE / 2.0
+        dist = numpy.hypot(chunk[0] + half - center[0], 
+                           chunk[1] + half - center[1])
+        far_step = (self.SIM_FAR_STEP 
+                    if self._sim_ticks % self.SIM_FAR_STEP == 0 else 0)
+        return numpy.where(dist <= self.SIM_NEAR, 1, 
+                           numpy.where(dist <= self.SIM_FAR, far_step, 0))
+    
+    def get_chunk(self, x, y):
+        """Return the Chunk containing coordinates, or None if not loaded."""
+        return self._chunks.get((x - x % self.CHUNK_SIZE, 
+                                 y - y % self.CHUNK_SIZE))
+    
+    def load_around(self, pos):
+        """Load and unload strips of chunks for a player at grid pos."""
+        x_min = max(int(pos[0]) - self.LOAD_RADIUS, 0)
+        x_max = min(int(pos[0]) + self.LOAD_RADIUS, self.size[0] - 1)
+        self.load_strips([x for x in xrange(x_min - x_min % self.CHUNK_SIZE, 
+                                            x_max + 1, self.CHUNK_SIZE)
+                          if x not in self._loaded_strips])
+        for x in list(self._loaded_strips):
+            if (abs(x + self.CHUNK_SIZE / 2 - pos[0]) > self.UNLOAD_RADIUS and
+                    (self.regions != None or not self.is_strip_dirty(x))):
+                self.unload_strip(x)
+    
+    def load_strips(self, xs):
+        """Load or generate the chunks of the strips with left edges xs.
+        
+        A strip with any chunks which weren't saved is generated whole, since
+        grass depends on the blocks above. All the strips to generate are
+        generated at once by GENERATION_WORKERS processes, which are started
+        the first time and kept until close is called.
+        """
+        ys = range(0, self.size[1], self.CHUNK_SIZE)
+        saved = {} # strip x -> saved Chunk of each y, or None if not saved
+        for x in xs:
+            saved[x] = [None] * len(ys)
+            if self.regions != None:
+                saved[x] = [self.regions.load_chunk((x, y)) for y in ys]
+        bands = [(x, min(self.CHUNK_SIZE, self.size[0] - x)) for x in xs
+                 if None in saved[x]]
+        strips = {} # strip x -> Grid of generated blocks
+        if bands:
+            if self._band_generator == None:
+                # enough columns for every strip within LOAD_RADIUS
+                max_width = ((2 * self.LOAD_RADIUS / self.CHUNK_SIZE + 2) *
+                             self.CHUNK_SIZE)
+                self._band_generator = map_generation.BandGenerator(
+                        self.generator.seed, max_width, self.size[1], 
+                        self.GENERATION_WORKERS)
+            blocks = self._band_generator.generate(bands, 
+                                                   self.generator.timings)
+            offset = 0
+            for (x, width) in bands:
+                band = blocks[:, offset:offset + width]
+                strips[x] = Grid((width, self.size[1]), data=band.tostring())
+                offset += width
+        for x in xs:
+            self.load_strip(x, saved[x], strips.get(x))
+    
+    def load_strip(self, x, saved, strip):
+        """Add the chunks of the strip with left edge x to the map.
+        
+        saved: list of the strip's saved Chunks from the top, or None for
+            chunks to take from strip.
+        strip: Grid of the generated blocks of the strip, or None.
+        
+        Light is computed from the blocks of the chunks, whether they were
+        saved or generated, and spread between them and the rest of the map.
+        """
+        width = min(self.CHUNK_SIZE, self.size[0] - x)
+        for (y, chunk) in zip(xrange(0, self.size[1], self.CHUNK_SIZE), saved):
+            if chunk == None:
+                height = min(self.CHUNK_SIZE, self.size[1] - y)
+                chunk = Chunk((x, y), strip.get_region((0, y, width, height)))
+            self._chunks[(x, y)] = chunk
+            # in case it was drawn before it was loaded
+            self._chunk_renders.discard((x, y))
+            self._overlay_renders.discard((x, y))
+        self._loaded_strips.add(x)
+        
+        for bx in xrange(x, x + width):
+            self.solid_columns.load_column(bx)
+            self.solid_rows.load_column(bx)
+        self.light.load_columns(x, x + width - 1)
+        for y in xrange(0, self.size[1], self.CHUNK_SIZE):
+            self.schedule_chunk_ticks(self._chunks[(x, y)])
+        # light has spread into the neighbouring strips
+        cs = self.CHUNK_SIZE
+        self.invalidate_light([(bx, by) for by in xrange(0, self.size[1], cs)
+                               for bx in [x - 2 * cs, x - cs, 
+                                          x + width, x + width + cs]])
+    
+    def unload_strip(self, x):
+        """Save changed chunks of the strip with left edge x and unload it."""
+        self.save_strip(x)
+        width = min(self.CHUNK_SIZE, self.size[0] - x)
+        self.light.unload_columns(x, x + width - 1)
+        for bx in xrange(x, x + width):
+            self.solid_columns.unload_column(bx)
+            self.solid_rows.unload_column(bx)
+        for y in xrange(0, self.size[1], self.CHUNK_SIZE):
+            del self._chunks[(x, y)]
+            self._chunk_renders.discard((x, y))
+            self._overlay_renders.discard((x, y))
+        self._loaded_strips.remove(x)
+    
+    def save_strip(self, x):
+        """Save the changed chunks of the strip with left edge x, if saving."""
+        if self.regions == None:
+            return
+        for y in xrange(0, self.size[1], self.CHUNK_SIZE):
+            chunk = self._chunks[(x, y)]
+            if chunk.dirty:
+                self.regions.save_chunk(chunk)
+                chunk.dirty = False
+    
+    def save(self):
+        """Save every changed chunk, if the map has a save directory."""
+        for x in self._loaded_strips:
+            self.save_strip(x)
+    
+    def close(self):
+        """Stop the processes generating strips and close the region files.
+        
+        Changed chunks must already have been saved with save.
+        """
+        if self._band_generator != None:
+            self._band_generator.close()
+            self._band_generator = None
+        if self.regions != None:
+            self.regions.close()
+    
+    def is_strip_dirty(self, x):
+        """Return True if a block was changed in the strip with left edge x."""
+        return any(self._chunks[(x, y)].dirty 
+                   for y in xrange(0, self.size[1], self.CHUNK_SIZE))
     
     def get_block(self, x, y):
-        """Return the block id at coordinates, or None if out of range."""
-        if (x in xrange(0, self.size[0]) and y in xrange(0, self.size[1])):
-            i = (y * self.size[1]) + x
-            return self._blocks[i]
-        else:
+        """Return the block id at coordinates, or None if not loaded."""
+        chunk = self.get_chunk(x, y)
+        if chunk == None:
             return None
+        return chunk.blocks.get(x - chunk.pos[0], y - chunk.pos[1])
     
     def set_block(self, x, y, block_id):
         """Set the block at coordinates to block_id.
         
-        Fails if block coords are out of range.
+        Fails if block coords are not loaded.
+        """
+        self.set_blocks([(x, y, block_id)])
+    
+    def set_blocks(self, blocks):
+        """Set many blocks from a list of (x, y, block_id) tuples at once.
+        
+        All the blocks are changed before the area around them is relit, so
+        relighting costs about the same as for one block changed in an area
+        that size, and each changed chunk is invalidated once. Blocks which
+        already have the given id are skipped.
+        
+        Fails if block coords are not loaded.
         """
-        assert self.get_block(x, y) != None
-        i = (y * self.size[1]) + x
-        self._blocks[i] = block_id
+        changed = []
+        for (x, y, block_id) in blocks:
+            chunk = self.get_chunk(x, y)
+            (cx, cy) = (x - chunk.pos[0], y - chunk.pos[1])
+            if chunk.blocks.get(cx, cy) == block_id:
+                continue
+            chunk.set_block(cx, cy, block_id)
+            chunk.dirty = True
+            self.solid_columns.set_solid(x, y, IS_SOLID[block_id])
+            self.solid_rows.set_solid(x, y, IS_SOLID[block_id])
+            changed.append((x, y))
+        if not changed:
+            return
         # invalidate the chunk cache
-        cx = x / self.CHUNK_SIZE * self.CHUNK_SIZE
-        cy = y / self.CHUNK_SIZE * self.CHUNK_SIZE
-        if (cx, cy) in self._chunk_cache:
-            del self._chunk_cache[(cx, cy)] # TODO: reuse surface?
+        self.invalidate_blocks(changed)
         
         # update lighting and invalidate changed chunks
-        # for every block with changed lighting, invalidate its chunk
-        changed_blocks = self.light.update_light(x, y)
-        for block in changed_blocks:
-            cx = block[0] / self.CHUNK_SIZE * self.CHUNK_SIZE
-            cy = block[1] / self.CHUNK_SIZE * self.CHUNK_SIZE
-            if (cx, cy) in self._chunk_cache:
-                del self._chunk_cache[(cx, cy)]
+        relit = self.light.update_light(changed)
+        self.invalidate_light(relit)
+        self.schedule_block_ticks(changed, relit)
+    
+    def schedule_block_ticks(self, changed, relit):
+        """Schedule ticks for grass which may change after blocks changed.
+        
+        changed is a list of the changed blocks, and relit is a list of blocks
+        whose light levels changed because of them. Grass may be able to
+        change if it or a neighbour changed, or a neighbour became dirt at
+        full light.
+        """
+        blocks = set((bx, by) for (x, y) in changed 
+                     for bx in xrange(x - 1, x + 2)
+                     for by in xrange(y - 1, y + 2))
+        for (bx, by) in relit:
+            bid = self.get_block(bx, by)
+            if bid == Block.names["grass"]:
+                blocks.add((bx, by))
+            elif (bid == Block.names["dirt"] and 
+                  self.light.get_light(bx, by) == self.light.MAX_LIGHT_LEVEL):
+                blocks.update((nx, ny) for nx in xrange(bx - 1, bx + 2)
+                              for ny in xrange(by - 1, by + 2))
+        for block in blocks:
+            self.schedule_grass_tick(*block)
+    
+    def schedule_chunk_ticks(self, chunk):
+        """Schedule ticks for the grass in a chunk which can change."""
+        if chunk.blocks.get_uniform() not in [None, Block.names["grass"]]:
+            return
+        (width, height) = chunk.size
+        for y in xrange(height):
+            for x in xrange(width):
+                if chunk.blocks.get(x, y) == Block.names["grass"]:
+                    self.schedule_grass_tick(chunk.pos[0] + x, 
+                                             chunk.pos[1] + y)
+    
+    def schedule_grass_tick(self, x, y):
+        """Schedule a tick for grass at (x, y) if it can die or spread.
+        
+        The tick is a random time in GRASS_TICK_DELAY from now.
+        """
+        if (self.block_ticks.is_scheduled((x, y)) or 
+                self.get_block(x, y) != Block.names["grass"]):
+            return
+        max_light = self.light.MAX_LIGHT_LEVEL
+        # dark grass dies, and bright dirt next to grass becomes grass
+        can_change = (self.light.get_light(x, y) < max_light or
+                      any(self.light.get_light(*pos) == max_light and 
+                          self.get_block(*pos) == Block.names["dirt"]
+                          for pos in [(x-1,y),(x+1,y),(x,y-1),(x,y+1),
+                                      (x-1,y-1),(x+1,y+1),(x-1,y+1),
+                                      (x+1,y-1)]))
+        if can_change:
+            self.block_ticks.schedule((x, y), 
+                                      1000 * uniform(*self.GRASS_TICK_DELAY))
+    
+    def tick_block(self, x, y):
+        """Update the block at (x, y) when its scheduled tick is due."""
+        bid = self.get_block(x, y)
+        if bid == Block.names["grass"]:
+            changes = []
+            
+            # kill grass which is too dark
+            if self.light.get_light(x, y) < self.light.MAX_LIGHT_LEVEL:
+                changes.append((x, y, Block.names["dirt"]))
+            
+            # spread grass to adjacent blocks which are bright enough
+            for pos in [(x-1,y),(x+1,y),(x,y-1),(x,y+1),(x-1,y-1),
+                        (x+1,y+1),(x-1,y+1),(x+1,y-1)]:
+                if (self.light.get_light(*pos) == self.light.MAX_LIGHT_LEVEL 
+                        and self.get_block(*pos) == Block.names["dirt"]):
+                    changes.append((pos[0], pos[1], Block.names["grass"]))
+            
+            # grass and dirt block light the same, so they can change at once
+            self.set_blocks(changes)
+    
+    def invalidate_blocks(self, blocks):
+        """Invalidate the given blocks in the cached chunks containing them."""
+        for (chunk, chunk_blocks) in self.group_by_chunk(blocks).iteritems():
+            self._chunk_renders.invalidate(chunk, chunk_blocks)
+    
+    def group_by_chunk(self, blocks, margin=0):
+        """Return a dict of chunk pos -> list of the given blocks in it.
+        
+        With a margin, each block is also listed in the chunks containing the
+        blocks up to margin blocks away from it.
+        """
+        chunks = {}
+        cs = self.CHUNK_SIZE
+        offsets = xrange(-margin, margin + 1)
+        for block in blocks:
+            for chunk in set(((block[0] + mx) / cs * cs, 
+                              (block[1] + my) / cs * cs)
+                             for mx in offsets for my in offsets):
+                chunks.setdefault(chunk, []).append(block)
+        return chunks
+    
+    def invalidate_light(self, blocks):
+        """Invalidate the lighting of the chunks containing the given blocks.
+        
+        In overlay mode only the light overlays need redrawing, otherwise the
+        chunks themselves are invalidated.
+        """
+        if not self.LIGHT_OVERLAY:
+            self.invalidate_blocks(blocks)
+            return
+        # with smooth lighting, light also bleeds into neighbouring chunks
+        margin = 1 if self.SMOOTH_LIGHT else 0
+        for (chunk, chunk_blocks) in self.group_by_chunk(blocks, 
+                                                         margin).iteritems():
+            self._overlay_renders.invalidate(chunk, chunk_blocks)
 
     def is_solid_block(self, x, y):
         """Return True if block at given coordinates is solid. 
@@ -247,30 +587,116 @@ class Map:
         Assumes blocks outside map are not solid.
         """
         block_id = self.get_block(x, y)
-        return (block_id != None and Block(block_id).is_solid)
+        return (block_id != None and IS_SOLID[block_id])
 
     def draw_chunk(self, surf, pos):
         """Draw a self.CHUNK_SIZE square of the map tiles.
         
         surf: Surface to draw to.
         pos: The top-left position of the map chunk to draw.
+        
+        In overlay mode, chunks made of one kind of block all look the same,
+        so they are copied from a surface drawn the first time one is seen.
         """
-        surf.fill((100, 100, 255))
+        chunk = self.get_chunk(*pos)
+        if (self.LIGHT_OVERLAY and chunk != None and 
+                chunk.size == (self.CHUNK_SIZE, self.CHUNK_SIZE) and
+                chunk.blocks.get_uniform() != None):
+            bid = chunk.blocks.get_uniform()
+            if bid not in self._uniform_chunk_surfs:
+                uniform_surf = pygame.Surface(surf.get_size(), 0, surf)
+                self._draw_tiles(uniform_surf, pos)
+                self._uniform_chunk_surfs[bid] = uniform_surf
+            surf.blit(self._uniform_chunk_surfs[bid], (0, 0))
+        else:
+            self._draw_tiles(surf, pos)
+
+    def _draw_tiles(self, surf, pos):
+        """Draw the tiles of a chunk one by one, as in draw_chunk."""
+        surf.fill(self.BACKGROUND_COLOR)
         # figure out range of tiles in this chunk
         tile_range = [(int(pos[i]), 
                        int(ceil(pos[i] + surf.get_size()[i] / self.TILE_SIZE)))
                        for i in [0, 1]]
-        for x in xrange(*(tile_range[0])):
-            for y in xrange(*(tile_range[1])):
-                (px, py) = self.grid_to_px(pos, (x,y))
-                bid = self.get_block(x, y)
-                if bid != None:
-                    block = Block(bid)
-                    light_level = self.light.get_light(x, y)
-                    block_surf = block.lit_surfs[light_level]
-                    surf.blit(block_surf, (px, py))
+        blocks = [(x, y) for x in xrange(*(tile_range[0]))
+                  for y in xrange(*(tile_range[1]))]
+        surf.blits(self._tile_blits(pos, blocks), False)
+
+    def patch_chunk(self, surf, pos, blocks):
+        """Redraw some blocks of a chunk drawn by draw_chunk.
+        
+        surf: Surface the chunk was drawn to.
+        pos: The top-left position of the map chunk.
+        blocks: List of the blocks in the chunk to redraw.
+        """
+        for block in blocks:
+            surf.fill(self.BACKGROUND_COLOR, 
+                      self.grid_to_px(pos, block) + (self.TILE_SIZE, 
+                                                     self.TILE_SIZE))
+        surf.blits(self._tile_blits(pos, blocks), False)
+
+    def _tile_blits(self, pos, blocks):
+        """Return Surface.blits arguments for drawing blocks of a chunk.
+        
+        All the tiles are drawn from the block atlas. Blocks which aren't
+        loaded are skipped.
+        """
+        (atlas, rects) = BLOCK_ATLAS.get()
+        blits = []
+        for (x, y) in blocks:
+            bid = self.get_block(x, y)
+            if bid != None:
+                if self.LIGHT_OVERLAY:
+                    light_level = self.light.MAX_LIGHT_LEVEL
                 else:
-                    pass #FIXME
+                    light_level = self.light.get_visible_light(x, y)
+                blits.append((atlas, self.grid_to_px(pos, (x,y)),
+                              rects[bid][light_level]))
+        return blits
+
+    def draw_light_overlay(self, surf, pos):
+        """Draw the darkness overlay of a chunk.
+        
+        surf: Surface to draw to, from the overlay cache.
+        pos: The top-left position of the map chunk.
+        
+        One pixel is drawn per block, with alpha depending on its light level,
+        then scaled up to cover the chunk. The overlay includes a margin of one
+        block around the chunk so that smooth lighting blends across chunk
+        edges.
+        """
+        tiny = self._overlay_tiny
+        for tx in xrange(tiny.get_width()):
+            for ty in xrange(tiny.get_height()):
+                # clamp to the map so edges aren't blended with darkness
+                x = min(max(pos[0] + tx - 1, 0), self.size[0] - 1)
+                y = min(max(pos[1] + ty - 1, 0), self.size[1] - 1)
+                tiny.set_at((tx, ty), self.get_darkness(x, y))
+        if self.SMOOTH_LIGHT:
+            pygame.transform.smoothscale(tiny, surf.get_size(), surf)
+        else:
+            pygame.transform.scale(tiny, surf.get_size(), surf)
+
+    def patch_light_overlay(self, surf, pos, blocks):
+        """Redraw some blocks of a light overlay drawn by draw_light_overlay.
+        
+        With smooth lighting each block is blended with its neighbours, so
+        the whole overlay is redrawn instead.
+        """
+        if self.SMOOTH_LIGHT:
+            self.draw_light_overlay(surf, pos)
+            return
+        for (x, y) in blocks:
+            # overlays are offset by their margin
+            (px, py) = self.grid_to_px(pos, (x + 1, y + 1))
+            surf.fill(self.get_darkness(x, y), 
+                      (px, py, self.TILE_SIZE, self.TILE_SIZE))
+
+    def get_darkness(self, x, y):
+        """Return the light overlay colour of the block at (x, y)."""
+        max_level = float(self.light.MAX_LIGHT_LEVEL)
+        light_level = self.light.get_visible_light(x, y) or 0
+        return (0, 0, 0, int(255 * (1 - light_level / max_level)))
 
     def get_chunks_in_rect(self, rect):
         """Generate the list of chunks inside a rect."""
@@ -289,15 +715,86 @@ class Map:
                       if c % self.CHUNK_SIZE == 0]:
                 yield (x, y)
 
+    def get_map_chunks_in_px_rect(self, rect):
+        """Return the chunks of the map inside a rect of map pixels.
+        
+        Map pixels are grid positions times TILE_SIZE. Chunks outside the map
+        are left out.
+        """
+        grid_rect = [float(n) / self.TILE_SIZE for n in 
+                     (rect[0][0], rect[0][1], rect[1][0], rect[1][1])]
+        return [(x, y) for (x, y) in self.get_chunks_in_rect(grid_rect)
+                if 0 <= x < self.size[0] and 0 <= y < self.size[1]]
+
+    def draw_buffer(self, surf, origin, rect):
+        """Draw the cached chunks to part of the viewport backbuffer.
+        
+        surf: The backbuffer.
+        origin: Map pixel position of the top-left of surf.
+        rect: Area of surf to draw.
+        
+        Chunks which haven't been rendered yet are left as background, and
+        drawn when their renders are updated.
+        """
+        surf.set_clip(rect)
+        surf.fill(self.BACKGROUND_COLOR)
+        chunk_px = self.CHUNK_SIZE * self.TILE_SIZE
+        area = ((origin[0] + rect[0], origin[1] + rect[1]), (rect[2], rect[3]))
+        for (x, y) in self.get_map_chunks_in_px_rect(area):
+            chunk_surf = self._chunk_renders.peek((x, y))
+            overlay = None
+            if self.LIGHT_OVERLAY:
+                overlay = self._overlay_renders.peek((x, y))
+                if overlay == None:
+                    continue
+            if chunk_surf == None:
+                continue
+            blit_pos = (x * self.TILE_SIZE - origin[0], 
+                        y * self.TILE_SIZE - origin[1])
+            surf.blit(chunk_surf, blit_pos)
+            # darken the chunk by its light overlay, skipping the margin
+            if overlay != None:
+                surf.blit(overlay, blit_pos, (self.TILE_SIZE, self.TILE_SIZE, 
+                                              chunk_px, chunk_px))
+        surf.set_clip(None)
+
+    def schedule_renders(self, visible, visible_rect):
+        """Spend RENDER_BUDGET ms rendering chunks before they're needed.
+        
+        visible: positions of chunks on screen.
+        visible_rect: (x, y, w, h) grid rect on screen.
+        
+        Chunks are rendered ahead of the player in the direction they're
+        moving, in the area they'll be able to see in PREFETCH_TIME seconds.
+        """
+        # TODO: hack to get player
+        player = self.entities[0]
+        (ahead_x, ahead_y) = (player.dx * self.PREFETCH_TIME, 
+                              player.dy * self.PREFETCH_TIME)
+        # the area which will be visible, with a margin of a chunk
+        prefetch_rect = (visible_rect[0] + min(ahead_x, 0) - self.CHUNK_SIZE,
+                         visible_rect[1] + min(ahead_y, 0) - self.CHUNK_SIZE,
+                         visible_rect[2] + abs(ahead_x) + 2 * self.CHUNK_SIZE,
+                         visible_rect[3] + abs(ahead_y) + 2 * self.CHUNK_SIZE)
+        prefetch = [chunk for chunk in self.get_chunks_in_rect(prefetch_rect)
+                    if chunk in self._chunks]
+        center = player.get_center()
+        focus = (center[0] + ahead_x - self.CHUNK_SIZE / 2, 
+                 center[1] + ahead_y - self.CHUNK_SIZE / 2)
+        
+        deadline = time() + self.RENDER_BUDGET / 1000.0
+        self._chunk_renders.run(deadline, visible, prefetch, focus)
+        if self.LIGHT_OVERLAY:
+            self._overlay_renders.run(deadline, visible, prefetch, focus)
+
     def draw(self, surf, pos):
         """Draw the map tiles and entites.
         
         surf: Surface to draw to.
         pos: Top-left grid position to draw.
-        surf_size: 
         
-        Note: negative chunks will causing rounding in the wrong direction, 
-        causing undrawn margins. Fix this by not drawing empty chunks.
+        The chunks are drawn to a backbuffer around the screen, which only
+        redraws the chunks which changed and the parts scrolled into view.
         """
         # figure out which chunks are onscreen
         # get topleft and bottomright grid positions of viewport
@@ -308,48 +805,47 @@ class Map:
         x_max = bottomright[0]
         y_min = topleft[1]
         y_max = bottomright[1]
-        # get min and max chunk positions inside viewport
-        chunks_x = (int(x_min) / self.CHUNK_SIZE * self.CHUNK_SIZE, 
-                    int(x_max) / self.CHUNK_SIZE * self.CHUNK_SIZE)
-        chunks_y = (int(y_min) / self.CHUNK_SIZE * self.CHUNK_SIZE, 
-                    int(y_max) / self.CHUNK_SIZE * self.CHUNK_SIZE)
-        # loop over every chunk to draw
-        for x in [c for c in xrange(chunks_x[0], chunks_x[1]+1) 
-                  if c % self.CHUNK_SIZE == 0]:
-            for y in [c for c in xrange(chunks_y[0], chunks_y[1]+1) 
-                      if c % self.CHUNK_SIZE == 0]:
-                # redraw the chunk if it's not cached
-                if (x, y) not in self._chunk_cache:
-                    print "chunk cache miss on %i,%i" % (x, y)
-                    now = pygame.time.get_ticks()
-                    # TODO: add margin to allow tile overlapping between chunks
-                    s = pygame.Surface((self.CHUNK_SIZE * self.TILE_SIZE, 
-                                        self.CHUNK_SIZE * self.TILE_SIZE))
-                    self.draw_chunk(s, (x, y))
-                    self._chunk_cache[(x, y)] = s
-                    elapsed = pygame.time.get_ticks() - now
-                    print "cached new chunk in %i ms" % elapsed
-                # rounding pos and blit_pos seems to fix edges between chunks
-                blit_pos = self.grid_to_px((round(pos[0], 2), 
-                                            round(pos[1], 2)), (x, y))
-                blit_pos = (round(blit_pos[0]), round(blit_pos[1]))
-                surf.blit(self._chunk_cache[(x, y)], 
-                          blit_pos)
-        
-        # figure out which entities are onscreen and draw them
-        for entity in self.entities:
+        visible_rect = (x_min, y_min, x_max - x_min, y_max - y_min)
+        
+        # scroll the backbuffer
+        view = (int(round(pos[0] * self.TILE_SIZE)), 
+                int(round(pos[1] * self.TILE_SIZE)))
+        self._viewport.move(surf, view)
+        visible = self.get_map_chunks_in_px_rect((view, surf.get_size()))
+        
+        # re-render changed chunks and render chunks around the screen and
+        # ahead of the player, then render any missing chunks on screen
+        self._chunk_cache.start_frame()
+        self._overlay_cache.start_frame()
+        self.schedule_renders(visible, visible_rect)
+        for chunk in visible:
+            self._chunk_renders.get(chunk)
+            if self.LIGHT_OVERLAY:
+                self._overlay_renders.get(chunk)
+        
+        # redraw the chunks which were rendered since the last frame
+        chunk_px = self.CHUNK_SIZE * self.TILE_SIZE
+        for renders in [self._chunk_renders, self._overlay_renders]:
+            for (x, y) in renders.updated:
+                self._viewport.invalidate((x * self.TILE_SIZE, 
+                                           y * self.TILE_SIZE, 
+                                           chunk_px, chunk_px))
+            renders.updated.clear()
+        self._viewport.draw(surf)
+        
+        # figure out which entities are onscreen and draw them, with a margin
+        # of a chunk for the parts outside their chunks
+        cs = self.CHUNK_SIZE
+        margin_rect = (x_min - cs, y_min - cs, 
+                       x_max - x_min + 2 * cs, y_max - y_min + 2 * cs)
+        for entity in self.entity_index.in_rect(margin_rect):
             topleft = (entity.x, entity.y)
             p_tl = self.grid_to_px(pos, topleft)
-            # TODO: clip entities offscreen
             entity.draw(p_tl[0], p_tl[1], entity.width * self.TILE_SIZE,
                         entity.height * self.TILE_SIZE, surf=surf)
     
-        # draw particle systems
-        for ps_pos in self._particle_systems:
-            (ps, g_pos) = ps_pos
-            p_pos = self.grid_to_px(pos, g_pos)
-            # TODO: clip
-            ps.draw(surf, p_pos)
+        # draw particles
+        self.particles.draw(surf, self.grid_to_px(pos, (0, 0)))
         
         # draw selected block
         if self.cursor_pos != None:
@@ -380,47 +876,59 @@ class Map:
     def update(self, millis):
         """Update entities, particle systems, and blocks in the map.
         
-        Blocks are updated in a rectangle around the player. Random blocks in
-        this rectangle are chosen to be updated each call.
+        Blocks are ticked when they're due in block_ticks, within the time
+        budget for ticking blocks. Every loaded grass block which can die or
+        spread is scheduled, when its chunk is loaded or when it or the blocks
+        around it change.
+        
+        Entities are all moved at once by physics, and then moved to the
+        buckets of entity_index for the chunks they moved into. With SIM_LOD,
+        entities and particle systems in chunks far from the player are
+        updated less often, and not at all outside SIM_FAR, where the map may
+        not be loaded. Particle systems there still age and expire, but don't
+        spawn particles. Lights carried by entities are moved along with them,
+        and relit within the time budget for moving lights.
         """
+        # TODO: hack to get player pos
+        self.load_around(self.entities[0].get_center())
+        
+        center = self.entities[0].get_center()
+        if self.SIM_LOD:
+            steps = self._get_sim_steps(
+                    self.physics.get_chunks(self.CHUNK_SIZE), center)
+            rows = numpy.flatnonzero(steps)
+            self.physics.update(millis, self.solid_rows, rows, steps[rows])
+        else:
+            self.physics.update(millis, self.solid_rows)
+        self._index_entities()
         for entity in self.entities:
-            entity.update(millis, self)
+            if entity.light_source != None:
+                (entity.light_source.x,
+                 entity.light_source.y) = entity.get_center()
+        self.invalidate_light(
+                self.light.dynamic.update(self.DYNAMIC_LIGHT_BUDGET))
         
-        for ps_pos in self._particle_systems:
-            (ps, pos) = ps_pos
-            ps.update(millis)
-            if ps.is_expired():
-                self._particle_systems.remove(ps_pos)
+        self.particles.update(millis)
+        for (chunk, bucket) in self._particle_systems.get_buckets():
+            steps = int(self._get_sim_steps(chunk, center))
+            for ps_pos in list(bucket):
+                (ps, pos) = ps_pos
+                # always age, so far away systems still expire
+                ps.update(millis, self.particles, 
+                          (pos[0] * self.TILE_SIZE, pos[1] * self.TILE_SIZE),
+                          millis * steps)
+                if ps.is_expired():
+                    self._particle_systems.remove(ps_pos)
+        self._sim_ticks += 1
         
-        # TODO: hack to get player pos
-        update_center = (int(self.entities[0].x), int(self.entities[0].y))
-        # loop so updates occur at specified frequency
-        for i in xrange(int(ceil(millis /
-                                 float(self.BLOCK_UPDATE_FREQ * 1000)))):
-            x = randrange(update_center[0] - self.BLOCK_UPDATE_SIZE[0]/2, 
-                          update_center[0] + self.BLOCK_UPDATE_SIZE[0]/2 + 1)
-            y = randrange(update_center[1] - self.BLOCK_UPDATE_SIZE[1]/2, 
-                          update_center[1] + self.BLOCK_UPDATE_SIZE[1]/2 + 1)
-            # update block at (x, y)
-            bid = self.get_block(x, y)
-            if bid == Block(name="grass").id:
-                
-                # kill grass which is too dark
-                if self.light.get_light(x, y) < self.light.MAX_LIGHT_LEVEL:
-                    self.set_block(x, y, Block(name="dirt").id)
-                
-                # spread grass to adjacent blocks which are bright enough
-                for pos in [(x-1,y),(x+1,y),(x,y-1),(x,y+1),(x-1,y-1),
-                            (x+1,y+1),(x-1,y+1),(x+1,y-1)]:
-                    if (self.light.get_light(*pos) == self.light.MAX_LIGHT_LEVEL 
-                            and self.get_block(*pos) == Block(name="dirt").id):
-                        self.set_block(pos[0], pos[1], Block(name="grass").id)
+        self.block_ticks.update(millis, self.BLOCK_TICK_BUDGET)
 
     def rect_colliding(self, rect, assume_solid=None):
         """Return true if the given rect will collide with the map.
         
         This works by finding all the map blocks inside the rect, and 
-        returning true if any of them are solid blocks.
+        returning true if any of them are solid blocks, using the bitmasks of
+        solid_rows.
         
         rect should be a (x, y, w, h) tuple since pygame Rects don't use 
         floats.
@@ -434,11 +942,12 @@ class Map:
         # get range of blocks inside the given rect
         x_range = (int(r_x), int(ceil(r_x + r_w)))
         y_range = (int(r_y), int(ceil(r_y + r_h)))
-        for x in xrange(x_range[0], x_range[1]):
-            for y in xrange(y_range[0], y_range[1]):
-                if self.is_solid_block(x, y) or (x, y) == assume_solid:
-                    return True
-        return False
+        if (assume_solid != None and 
+                x_range[0] <= assume_solid[0] < x_range[1] and 
+                y_range[0] <= assume_solid[1] < y_range[1]):
+            return True
+        return self.solid_rows.any_solid(x_range[0], y_range[0], 
+                                         x_range[1], y_range[1])
 
 
 class Game:
@@ -448,10 +957,12 @@ class Game:
         self.WIDTH = 800
         self.HEIGHT = 600
         self.FPS = 60
-        self.MAP_SIZE = (100, 100)
+        self.MAP_SIZE = (1000, 100)
+        self.SAVE_DIR = "world"
         self.PLAYER_POS = (0.5, 0.5)
         self.PLAYER_SIZE = (1.5, 1.5)
         self.PLAYER_REACH = 4
+        self.PLAYER_LIGHT = 8 # brightness of the player's torch
         self.HUD_HEIGHT = 50
         
         pygame.init()
@@ -462,9 +973,14 @@ class Game:
         
         self.clock = pygame.time.Clock()
         
-        self.map = Map(self.MAP_SIZE)
-        self.player = MapEntity(*(self.PLAYER_POS + self.PLAYER_SIZE + (0, 0)))
-        self.map.entities.append(self.player)
+        self.map = Map(self.MAP_SIZE, save_dir=self.SAVE_DIR)
+        self.player = self.map.add_entity(
+                x=self.PLAYER_POS[0], y=self.PLAYER_POS[1], 
+                width=self.PLAYER_SIZE[0], height=self.PLAYER_SIZE[1])
+        self.map.load_around(self.player.get_center())
+        self.player.light_source = LightSource(
+                *(self.player.get_center() + (self.PLAYER_LIGHT,)))
+        self.map.light.dynamic.add_source(self.player.light_source)
         
         hud_rect = (0, self.screen_size[1] - self.HUD_HEIGHT, 
                     self.screen_size[0], self.HUD_HEIGHT)
@@ -478,6 +994,8 @@ class Game:
         """Handle events from pygame."""
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
+                self.map.save()
+                self.map.close()
                 pygame.quit()
                 exit(0)
             elif event.type == pygame.KEYDOWN:
@@ -507,14 +1025,14 @@ class Game:
                                                        self.map.cursor_pos)
                         (gx, gy) = (int(gx), int(gy))
                         block_id = self.map.get_block(gx, gy)
-                        if Block(block_id).is_solid:
+                        if IS_SOLID[block_id]:
                             # remove block
-                            self.map.set_block(gx, gy, Block(name="air").id)
+                            self.map.set_block(gx, gy, Block.names["air"])
                             self.hud.add_block(block_id)
-                            surf = Block(block_id).surf
-                            ps_pos = (particles.ParticleSystem(surf),
-                                      (gx+0.5, gy+0.5))
-                            self.map._particle_systems.append(ps_pos)
+                            surf = BLOCKS[block_id].surf
+                            self.map.add_particle_system(
+                                    particles.ParticleSystem(surf), 
+                                    (gx+0.5, gy+0.5))
                             angle = atan2(gx - self.player.x, gy -
                                           self.player.y)
                             self.player.punch((180/3.141) * angle)
@@ -0,0 +1,148 @@
+class Grid:
+    """A rectangular grid of small integers stored one byte per cell.
+
+    Cells are stored in row-major order in a bytearray, so a grid of any width
+    and height takes one byte per cell, and rows or parts of rows can be
+    accessed as memoryviews without copying. Values must be in 0-255.
+
+    This is used for the block ids of the map and its light levels.
+    """
+    def __init__(self, size, fill=0, data=None):
+        """Create a grid of size (width, height).
+
+        If data is given, it is a sequence of width * height values in
+        row-major order to copy into the grid. Otherwise every cell is set to
+        fill.
+        """
+        self.width = size[0]
+        self.height = size[1]
+        self.size = (self.width, self.height)
+        if data != None:
+            assert len(data) == self.width * self.height
+            self.cells = bytearray(data)
+        else:
+            self.cells = bytearray([fill]) * (self.width * self.height)
+
+    def in_bounds(self, x, y):
+        """Return True if (x, y) is inside the grid."""
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def index(self, x, y):
+        """Return the index of cell (x, y) in cells."""
+        return y * self.width + x
+
+    def get(self, x, y):
+        """Return the value at (x, y), or None if out of range."""
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.cells[y * self.width + x]
+        return None
+
+    def get_uniform(self):
+        """Return None, since the cells are stored separately.
+
+        See UniformGrid.
+        """
+        return None
+
+    def compact(self):
+        """Return a UniformGrid if every cell is the same, otherwise self."""
+        if self.cells and self.cells.count(self.cells[:1]) == len(self.cells):
+            return UniformGrid(self.size, self.cells[0])
+        return self
+
+    def set(self, x, y, value):
+        """Set the value at (x, y), which must be in range."""
+        assert 0 <= x < self.width and 0 <= y < self.height
+        self.cells[y * self.width + x] = value
+
+    def row_view(self, y, x_min=0, x_max=None):
+        """Return a memoryview of cells x_min to x_max (exclusive) of row y.
+
+        Writing to the view writes to the grid.
+        """
+        if x_max == None:
+            x_max = self.width
+        start = y * self.width
+        return memoryview(self.cells)[start + x_min:start + x_max]
+
+    def get_region(self, rect):
+        """Return a copy of the cells inside rect as a new Grid.
+
+        rect is (x, y, w, h) and must be inside the grid.
+        """
+        (x, y, w, h) = rect
+        assert self.in_bounds(x, y) and self.in_bounds(x + w - 1, y + h - 1)
+        region = Grid((w, h))
+        for row in xrange(h):
+            start = (y + row) * self.width + x
+            region.cells[row * w:(row + 1) * w] = self.cells[start:start + w]
+        return region
+
+    def set_region(self, pos, region):
+        """Copy the cells of Grid region into this grid with topleft at pos."""
+        (x, y) = pos
+        w = region.width
+        assert (self.in_bounds(x, y) and
+                self.in_bounds(x + w - 1, y + region.height - 1))
+        for row in xrange(region.height):
+            start = (y + row) * self.width + x
+            self.cells[start:start + w] = region.cells[row * w:(row + 1) * w]
+
+    def fill_region(self, rect, value):
+        """Set every cell inside rect to value."""
+        (x, y, w, h) = rect
+        assert self.in_bounds(x, y) and self.in_bounds(x + w - 1, y + h - 1)
+        fill = bytearray([value]) * w
+        for row in xrange(y, y + h):
+            start = row * self.width + x
+            self.cells[start:start + w] = fill
+
+
+class UniformGrid:
+    """A grid with every cell set to the same value, stored as one value.
+
+    Much of the map is all air or all rock, and much of its light is fully
+    dark or fully lit, so chunks use these until they're changed. It has the
+    reading methods of Grid, and get_uniform to find out that every cell is
+    the same. Use expand to get a Grid which can be changed.
+    """
+    def __init__(self, size, value):
+        """Create a grid of size (width, height) with every cell set to value.
+        """
+        self.width = size[0]
+        self.height = size[1]
+        self.size = (self.width, self.height)
+        self.value = value
+
+    @property
+    def cells(self):
+        """A bytearray of the cells in row-major order, as in Grid."""
+        return bytearray([self.value]) * (self.width * self.height)
+
+    def in_bounds(self, x, y):
+        """Return True if (x, y) is inside the grid."""
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def get(self, x, y):
+        """Return the value at (x, y), or None if out of range."""
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.value
+        return None
+
+    def get_uniform(self):
+        """Return the value of every cell."""
+        return self.value
+
+    def compact(self):
+        """Return self, which is already compact."""
+        return self
+
+    def expand(self):
+        """Return a Grid with the same cells, which can be changed."""
+        return Grid(self.size, self.value)
+
+    def get_region(self, rect):
+        """Return the cells inside rect as a new UniformGrid."""
+        (x, y, w, h) = rect
+        assert self.in_bounds(x, y) and self.in_bounds(x + w - 1, y + h - 1)
+        return UniformGrid((w, h), self.value)
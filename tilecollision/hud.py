@@ -1,6 +1,6 @@
 import pygame
 
-from blocks import Block
+from blocks import BLOCK_ATLAS, MAX_LIGHT_LEVEL
 
 class HUD:
     """The onscreen area for showing info. 
@@ -23,6 +23,8 @@ class HUD:
     def draw(self, surf):
         """Draw to the surface given."""
         cell_size = self.rect[3]
+        (atlas, rects) = BLOCK_ATLAS.get()
+        blits = [] # block and count images, drawn together at the end
         curr_x = 0
         for (i, block) in enumerate(self.inv_items):
             # draw cell background
@@ -38,16 +40,15 @@ class HUD:
             pygame.draw.rect(surf, col, cell_rect, 2)
             
             # draw block in center of cell_rect
-            block_surf = Block(block).surf
-            surf.blit(block_surf, 
-                       (cell_rect[0] + cell_size/2 - 
-                        block_surf.get_size()[0]/2,
-                        cell_rect[1] + cell_size/2 - 
-                        block_surf.get_size()[1]/2))
+            block_rect = rects[block][MAX_LIGHT_LEVEL]
+            blits.append((atlas, (cell_rect[0] + cell_size/2 - block_rect[2]/2,
+                                  cell_rect[1] + cell_size/2 - block_rect[3]/2),
+                          block_rect))
             # draw count
             count = self.inv_count[block]
             font_surf = self.font.render(str(count), True, (255, 255, 255))
-            surf.blit(font_surf, cell_rect)
+            blits.append((font_surf, cell_rect))
+        surf.blits(blits, False)
 
     def add_block(self, block_id):
         """Add a block to the inventory."""
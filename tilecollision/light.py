@@ -1,50 +1,141 @@
-from blocks import Block
+from bisect import bisect_left
+from collections import deque
+from time import time
 
+from blocks import IS_SOLID, OPACITY, BRIGHTNESS
+from grid import UniformGrid
 
-def expand(blocks):
-    """Return set of blocks resulting from "expanding" the given set of blocks.
-    
-    blocks: a list/set of (x, y) tuples.
-    
-    "Expanding" represents propagating the light by one step for every block
-    given.
-            X
-     X --> XXX
-            X
+
+# cache of diamond templates, keyed by radius
+_diamonds = {}
+
+
+def diamond(r):
+    """Return the column spans of a diamond (Manhattan ball) of radius r.
+
+    The diamond is returned as a tuple of (dx, half_height) pairs, one for each
+    column from -r to r. The cells of column dx are the cells with
+    -half_height <= dy <= half_height. Templates are computed once and cached.
+              X
+             XXX
+      r=2:  XXXXX
+             XXX
+              X
     """
-    new_blocks = []
-    for (x, y) in blocks:
-        new_blocks += [(x, y), (x+1, y), (x-1, y), (x, y+1), (x, y-1)]
-    return set(new_blocks)
+    if r not in _diamonds:
+        _diamonds[r] = tuple((dx, r - abs(dx)) for dx in xrange(-r, r + 1))
+    return _diamonds[r]
 
 
-def expand_n(pos, n):
-    """Return the set of blocks affected by a light source at pos.
-    
-    n: the max light value.
-    
-    This works by calling expand on pos n times.
+def column_spans(x, y_top, y_bottom, r, size):
+    """Return the cells within distance r of a vertical run of cells.
+
+    The run is the cells (x, y_top) to (x, y_bottom) inclusive. The result is
+    a list of (x, y_min, y_max) column spans clipped to a map of the given
+    size. This is the union of the diamonds around every cell in the run.
+    """
+    spans = []
+    for (dx, h) in diamond(r):
+        bx = x + dx
+        if 0 <= bx < size[0]:
+            y_min = max(y_top - h, 0)
+            y_max = min(y_bottom + h, size[1] - 1)
+            if y_min <= y_max:
+                spans.append((bx, y_min, y_max))
+    return spans
+
+
+def merge_spans(spans):
+    """Return the union of a list of (x, y_min, y_max) column spans.
+
+    The result is a list of column spans which don't overlap, sorted by x and
+    then y, so each block in any of the spans is in exactly one of them.
+    """
+    runs = {} # x -> list of (y_min, y_max)
+    for (x, y_min, y_max) in spans:
+        runs.setdefault(x, []).append((y_min, y_max))
+    merged = []
+    for x in sorted(runs):
+        column = sorted(runs[x])
+        (y_min, y_max) = column[0]
+        for (next_min, next_max) in column[1:]:
+            if next_min > y_max + 1:
+                merged.append((x, y_min, y_max))
+                (y_min, y_max) = (next_min, next_max)
+            else:
+                y_max = max(y_max, next_max)
+        merged.append((x, y_min, y_max))
+    return merged
+
+
+class SolidColumns:
+    """Sorted index of the solid blocks in each column of the map.
+
+    For each x coordinate, the y coordinates of the solid blocks are kept in
+    a sorted list, so the first solid block at or below a point can be found
+    with a binary search instead of scanning down the column. The index must
+    be kept up to date by calling set_solid whenever a block changes.
+
+    Only the columns of loaded chunks are indexed.
     """
-    return reduce(lambda x, y: expand(x), xrange(n - 1), [pos])
+    def __init__(self, map_blocks):
+        """Create an empty index for the given Map."""
+        self.map_blocks = map_blocks
+        self.columns = {} # x -> sorted list of solid y
+
+    def load_column(self, x):
+        """Build the index for column x from the map's blocks."""
+        self.columns[x] = [y for y in xrange(self.map_blocks.size[1])
+                           if IS_SOLID[self.map_blocks.get_block(x, y)]]
+
+    def unload_column(self, x):
+        """Forget the index for column x."""
+        del self.columns[x]
+
+    def set_solid(self, x, y, is_solid):
+        """Record whether the block at (x, y) is solid."""
+        column = self.columns[x]
+        i = bisect_left(column, y)
+        present = (i < len(column) and column[i] == y)
+        if is_solid and not present:
+            column.insert(i, y)
+        elif not is_solid and present:
+            del column[i]
+
+    def first_solid(self, x, y):
+        """Return y of the first solid block at or below (x, y), or None."""
+        column = self.columns[x]
+        i = bisect_left(column, y)
+        return column[i] if i < len(column) else None
 
 
 class Light:
     """Computes and stores light levels for the map.
     
-    The light level for every block in the map is stored at once, so if no 
-    blocks are being changed the player can move around without any lighting
-    updates.
+    The light level for every block in the loaded chunks is stored in the
+    chunks, so if no blocks are being changed the player can move around
+    without any lighting updates. When a strip of columns is loaded, its light
+    is computed and spread into the neighbouring columns.
     
     When a block is changed, every block whose light level could possibly
     change must be set to 0. Then the lighting for this local area must be 
-    recomputed. This ensures light can be "cut off" from its source.
+    recomputed. This ensures light can be "cut off" from its source. Since
+    light drops by at least one level per block, this area is the diamond of
+    radius MAX_LIGHT_LEVEL - 1 around the block, which is stored as a list of
+    column spans built from a cached template. When many blocks are changed
+    at once, the union of their areas is relit together, so each block in it
+    is only relit once however many of the areas it is in.
     
-    The update is completed by propagating light for every block in the area,
-    as well as for all blocks adjacent to the area.
+    The update is completed by propagating light from every source in the
+    area, as well as from all blocks adjacent to the area. The old light levels
+    of the area are compared to the new ones so that only the blocks which
+    actually changed are reported.
     
     Sunlight works by keeping an array of the y coordinate the sun falls on for
     each x coordinate in the map. When a block obscures the sun or reveals it,
-    extra blocks must be updated for the larger lighting change.
+    the area around the whole run of blocks between the old and new sun y
+    coordinates must be updated. The new sun y coordinate is looked up in the
+    Map's SolidColumns index, so no columns are scanned.
     """
     MAX_LIGHT_LEVEL = 15
     
@@ -52,104 +143,325 @@ class Light:
         """Init light map for the given Map."""
         self.map_blocks = map_blocks
         self.map_size = map_blocks.size
-        self.map_light = [0] * (self.map_size[0] * self.map_size[1])
-        # y coordinate receiving light for each column of blocks
-        self.sunlight_y = [self.map_size[1] - 1] * self.map_size[0]
+        self.solid_columns = map_blocks.solid_columns
+        # y coordinate receiving light for each loaded column of blocks
+        self.sunlight_y = {}
         
-        # compute light levels for whole map
-        for x in xrange(0, self.map_size[0]):
-            for y in xrange(0, self.map_size[1]):
+        # light from moving sources, kept separately from the chunks
+        self.dynamic = DynamicLight(self)
+
+    def load_columns(self, x_min, x_max):
+        """Compute light for the newly loaded columns x_min to x_max.
+
+        The blocks of the columns must already be loaded and indexed. Light
+        from neighbouring loaded columns spreads into the new columns, and
+        light from the new columns spreads out into them. The new columns'
+        chunks must not have any light yet.
+        """
+        sources = []
+        for x in xrange(x_min, x_max + 1):
+            self.sunlight_y[x] = self.find_sunlight_y(x, 0)
+        chunk_size = self.map_blocks.CHUNK_SIZE
+        for cx in xrange(x_min - x_min % chunk_size, x_max + 1, chunk_size):
+            for cy in xrange(0, self.map_size[1], chunk_size):
+                chunk = self.map_blocks.get_chunk(cx, cy)
+                xs = xrange(max(cx, x_min), min(cx + chunk.size[0], x_max + 1))
+                sources.extend(self.load_chunk_sources(chunk, xs))
+        for x in [x_min - 1, x_max + 1]:
+            if x in self.sunlight_y:
+                for y in xrange(0, self.map_size[1]):
+                    if self.get_light(x, y) > 0:
+                        sources.append((x, y))
+        self.propagate_light(sources)
+
+    def load_chunk_sources(self, chunk, xs):
+        """Light the blocks of chunk in columns xs from their sources.
+
+        Return a list of the blocks to spread light from. A chunk of one kind
+        of block, whose columns are all loaded, doesn't need each block to be
+        looked at if it is entirely in the sun, or entirely dark.
+        """
+        (cx, cy) = chunk.pos
+        (width, height) = chunk.size
+        ys = xrange(cy, cy + height)
+        block = chunk.blocks.get_uniform()
+        if block != None and len(xs) == width:
+            if (BRIGHTNESS[block] == 0 and
+                    all(self.sunlight_y[x] < cy for x in xs)):
+                # no light inside the chunk to spread
+                return []
+            if all(self.sunlight_y[x] >= cy + height - 1 for x in xs):
+                # all in the sun, so only the edges can spread light further
+                chunk.light = UniformGrid(chunk.size, self.MAX_LIGHT_LEVEL)
+                return [(x, y) for x in xs for y in ys
+                        if x in (xs[0], xs[-1]) or y in (ys[0], ys[-1])]
+        sources = []
+        for x in xs:
+            for y in ys:
+                level = self.source_level(x, y)
+                if level > 0:
+                    self.set_light(x, y, level)
+                    sources.append((x, y))
+        return sources
+
+    def unload_columns(self, x_min, x_max):
+        """Forget the sunlight of columns x_min to x_max.
+
+        Light already spread from them into loaded columns is kept.
+        """
+        for x in xrange(x_min, x_max + 1):
+            del self.sunlight_y[x]
+
+    def find_sunlight_y(self, x, y):
+        """Return the y coordinate the sun falls on in column x.
+
+        y must be at or above the first solid block in the column. If there are
+        no solid blocks, the bottom of the map is returned.
+        """
+        solid_y = self.solid_columns.first_solid(x, y)
+        return solid_y if solid_y != None else self.map_size[1] - 1
+
+    def source_level(self, x, y):
+        """Return the light level emitted by the block at (x, y) itself."""
+        if y <= self.sunlight_y[x]:
+            # this block is in the sun
+            return self.MAX_LIGHT_LEVEL
+        return BRIGHTNESS[self.map_blocks.get_block(x, y)]
+
+    def propagate_light(self, sources):
+        """Spread light from a list of (x, y) source blocks to the map.
+
+        Blocks are processed in buckets by decreasing light level, so every
+        block is spread from at most once, after its final level is known.
+        Light leaving a block is reduced by that block's opacity.
+        """
+        buckets = [[] for i in xrange(self.MAX_LIGHT_LEVEL + 1)]
+        for (x, y) in sources:
+            buckets[self.get_light(x, y)].append((x, y))
+        for level in xrange(self.MAX_LIGHT_LEVEL, 0, -1):
+            for (x, y) in buckets[level]:
+                if self.get_light(x, y) != level:
+                    continue # already reached by brighter light
                 bid = self.map_blocks.get_block(x, y)
-                if y < self.sunlight_y[x]:
-                    # this block is in the sun
-                    if Block(bid).is_solid:
-                        # this block will obscure the sun
-                        self.sunlight_y[x] = y
-                    self.set_light(x, y, self.MAX_LIGHT_LEVEL)
-                    self.propagate_light(x, y)
-                elif Block(bid).brightness > 0:
-                    # this block gives off light
-                    self.set_light(x, y, Block(bid).brightness)
-                    self.propagate_light(x, y)
-                
-                
-    def propagate_light(self, x, y):
-        """Spread light from one block to its neighbors recursively."""
-        level = self.get_light(x, y)
-        adjacent = [(x+1, y), (x-1, y), (x, y+1), (x, y-1)]
-        bid = self.map_blocks.get_block(x, y)
-        opacity = Block(bid).opacity
-        for (x, y) in adjacent:
-            adj_level = self.get_light(x, y)
-            if adj_level != None and adj_level < level - opacity:
-                self.set_light(x, y, level - opacity)
-                self.propagate_light(x, y)
+                new_level = level - OPACITY[bid]
+                if new_level <= 0:
+                    continue
+                for (ax, ay) in [(x+1, y), (x-1, y), (x, y+1), (x, y-1)]:
+                    adj_level = self.get_light(ax, ay)
+                    if adj_level != None and adj_level < new_level:
+                        self.set_light(ax, ay, new_level)
+                        buckets[new_level].append((ax, ay))
     
-    def update_light(self, x, y):
-        """Update light in area surrounding a changed block at (x, y).
+    def update_light(self, blocks):
+        """Update light in the area surrounding a list of changed blocks.
+        
+        The blocks must all have been changed already, so the overlapping
+        areas around them are relit together, once.
         
         Return a list of blocks whose light levels changed.
         """
-        area = None
-        bid = self.map_blocks.get_block(x, y)
-        if Block(bid).is_solid:
-            if y < self.sunlight_y[x]:
-                # new block has obscured the sun
-                self.sunlight_y[x] = y
-                # compute area to update now in shadow
-                by = y + 1
-                area = expand_n((x, y), self.MAX_LIGHT_LEVEL)
-                while (not Block(self.map_blocks.get_block(x, by)).is_solid 
-                        and y < self.map_size[1]):
-                    area = area.union(expand_n((x, by), self.MAX_LIGHT_LEVEL))
-                    by += 1
-        else:
-            if y == self.sunlight_y[x]:
-                # removed block has unobscured the sun
-                # find new sun y level and compute area to update now lit
-                by = y + 1
-                area = expand_n((x, y), self.MAX_LIGHT_LEVEL)
-                while (not Block(self.map_blocks.get_block(x, by)).is_solid 
-                        and y < self.map_size[1]):
-                    area = area.union(expand_n((x, by), self.MAX_LIGHT_LEVEL))
-                    by += 1
-                self.sunlight_y[x] = by
-        
-        if area == None:
-            area = expand_n((x, y), self.MAX_LIGHT_LEVEL)
+        radius = self.MAX_LIGHT_LEVEL - 1
+        # runs of blocks in each column whose surroundings need relighting
+        runs = [(x, y, y) for (x, y) in blocks if x in self.sunlight_y]
+        for x in set(x for (x, y, y_bottom) in runs):
+            old_sun_y = self.sunlight_y[x]
+            self.sunlight_y[x] = self.find_sunlight_y(x, 0)
+            if self.sunlight_y[x] != old_sun_y:
+                # the sun has been obscured or unobscured between them
+                runs.append((x, min(old_sun_y, self.sunlight_y[x]), 
+                             max(old_sun_y, self.sunlight_y[x])))
+        # only loaded columns are updated
+        area = [span for span in merge_spans(
+                    [span for (x, y_top, y_bottom) in runs for span in
+                     column_spans(x, y_top, y_bottom, radius, self.map_size)])
+                if span[0] in self.sunlight_y]
         
-        # clear all light in surrounding area
-        for (bx, by) in area:
-            if self.get_light(bx, by) != None:
+        # save and clear all light in surrounding area
+        old_light = []
+        for (bx, y_min, y_max) in area:
+            for by in xrange(y_min, y_max + 1):
+                old_light.append(self.get_light(bx, by))
                 self.set_light(bx, by, 0)
         
-        # update light in area
-        blocks = expand(area)
-        for (bx, by) in blocks:
-            bid = self.map_blocks.get_block(bx, by)
-            if bid != None:
-                if by <= self.sunlight_y[bx]:
-                    # this block is in the sun
-                    self.set_light(bx, by, self.MAX_LIGHT_LEVEL)
-                elif Block(bid).brightness > 0:
-                    # this block gives off light
-                    self.set_light(bx, by, Block(bid).brightness)
-                self.propagate_light(bx, by)
+        # find sources in the area, and the lit blocks adjacent to it
+        sources = []
+        for (bx, y_min, y_max) in merge_spans(
+                [span for (x, y_top, y_bottom) in runs for span in
+                 column_spans(x, y_top, y_bottom, radius + 1, 
+                              self.map_size)]):
+            if bx not in self.sunlight_y:
+                continue
+            for by in xrange(y_min, y_max + 1):
+                level = self.get_light(bx, by)
+                if level == 0:
+                    level = self.source_level(bx, by)
+                    if level == 0:
+                        continue
+                    self.set_light(bx, by, level)
+                sources.append((bx, by))
+        self.propagate_light(sources)
         
-        return area
+        # moving lights shining through the changed blocks must be recomputed
+        for (x, y) in blocks:
+            self.dynamic.block_changed(x, y)
+
+        # compare with the old light levels to find changed blocks
+        changed = []
+        old_light = iter(old_light)
+        for (bx, y_min, y_max) in area:
+            for by in xrange(y_min, y_max + 1):
+                if self.get_light(bx, by) != old_light.next():
+                    changed.append((bx, by))
+        return changed
     
     def get_light(self, x, y):
-        """Return light level at coordinates."""
-        if (x in xrange(0, self.map_size[0]) and
-                    y in xrange(0, self.map_size[1])):
-            i = (y * self.map_size[1]) + x
-            return self.map_light[i]
-        else:
+        """Return light level at coordinates, or None if not loaded."""
+        chunk = self.map_blocks.get_chunk(x, y)
+        if chunk == None:
+            return None
+        return chunk.light.get(x - chunk.pos[0], y - chunk.pos[1])
+
+    def get_visible_light(self, x, y):
+        """Return light level at coordinates including moving lights."""
+        level = self.get_light(x, y)
+        if level == None:
             return None
+        return max(level, self.dynamic.get_light(x, y))
     
     def set_light(self, x, y, light_level):
-        """Set light level at coordinates."""
-        assert self.get_light(x, y) != None
-        i = (y * self.map_size[1]) + x
-        self.map_light[i] = light_level
+        """Set light level at coordinates, which must be loaded."""
+        chunk = self.map_blocks.get_chunk(x, y)
+        chunk.set_light(x - chunk.pos[0], y - chunk.pos[1], light_level)
         
+
+
+class LightSource:
+    """A light which can move around the map, like a carried torch.
+
+    Move it by changing x and y. DynamicLight notices when it has entered a
+    new block.
+    """
+    def __init__(self, x, y, brightness):
+        """Create light at grid position (x, y) with the given brightness."""
+        self.x = x
+        self.y = y
+        self.brightness = brightness
+        self.block = None # block the current levels were computed from
+        self.levels = {} # (x, y) -> light level given by this source
+
+
+class DynamicLight:
+    """Light layer for LightSources which move every frame.
+
+    The static light map is expensive to update, so moving lights are kept in
+    a separate sparse layer which is combined with it by taking the max of
+    both levels. Each source remembers the blocks it lights. When it moves to
+    a new block, only the blocks it used to light and the blocks it now lights
+    are recomputed.
+
+    Sources which need relighting are queued, and update only works through
+    the queue until its time budget runs out. The rest wait for the next
+    frame, so many moving lights can't stall the game.
+    """
+    def __init__(self, light):
+        """Init an empty layer on top of the given Light."""
+        self.light = light
+        self.sources = []
+        self.levels = {} # (x, y) -> max level of all sources, if > 0
+        self._queue = deque() # sources waiting to be relit
+
+    def add_source(self, source):
+        """Start shining the given LightSource."""
+        self.sources.append(source)
+        self._enqueue(source)
+
+    def remove_source(self, source):
+        """Stop shining the given LightSource.
+
+        The blocks it lit are darkened during a following update.
+        """
+        self.sources.remove(source)
+        self._enqueue(source)
+
+    def get_light(self, x, y):
+        """Return the dynamic light level at coordinates."""
+        return self.levels.get((x, y), 0)
+
+    def block_changed(self, x, y):
+        """Queue relighting of sources shining through a changed block."""
+        for source in self.sources:
+            if (x, y) in source.levels:
+                self._enqueue(source)
+
+    def update(self, budget):
+        """Relight moved sources for up to budget milliseconds.
+
+        Return a list of blocks whose visible light levels changed.
+        """
+        for source in self.sources:
+            if (int(source.x), int(source.y)) != source.block:
+                self._enqueue(source)
+
+        changed = []
+        deadline = time() + budget / 1000.0
+        while self._queue and time() < deadline:
+            changed += self._relight(self._queue.popleft())
+        return changed
+
+    def _enqueue(self, source):
+        """Queue source to be relit if it isn't already."""
+        if source not in self._queue:
+            self._queue.append(source)
+
+    def _relight(self, source):
+        """Recompute the blocks lit by source and merge them into the layer.
+
+        Return a list of blocks whose visible light levels changed.
+        """
+        old_levels = source.levels
+        if source in self.sources:
+            source.block = (int(source.x), int(source.y))
+            source.levels = self._flood(source.block, source.brightness)
+        else:
+            source.block = None
+            source.levels = {}
+
+        changed = []
+        for block in set(old_levels).union(source.levels):
+            old = self.levels.get(block, 0)
+            new = max([s.levels.get(block, 0) for s in self.sources] + [0])
+            if new == old:
+                continue
+            if new > 0:
+                self.levels[block] = new
+            else:
+                del self.levels[block]
+            static = self.light.get_light(*block)
+            if max(static, old) != max(static, new):
+                changed.append(block)
+        return changed
+
+    def _flood(self, start, brightness):
+        """Return the levels of blocks lit by a light at start.
+
+        Light spreads the same way as in the static light map.
+        """
+        levels = {}
+        if self.light.get_light(*start) == None:
+            return levels
+        levels[start] = brightness
+        frontier = [start]
+        while frontier:
+            next_frontier = []
+            for (x, y) in frontier:
+                bid = self.light.map_blocks.get_block(x, y)
+                new_level = levels[(x, y)] - OPACITY[bid]
+                if new_level <= 0:
+                    continue
+                for adj in [(x+1, y), (x-1, y), (x, y+1), (x, y-1)]:
+                    if (levels.get(adj, 0) < new_level and
+                            self.light.get_light(*adj) != None):
+                        levels[adj] = new_level
+                        next_frontier.append(adj)
+            frontier = next_frontier
+        return levels
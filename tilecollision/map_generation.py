@@ -1,5 +1,8 @@
+import numpy
 import pygame
 from sys import exit
+from multiprocessing import Pool, RawArray, cpu_count
+from time import time
 import random
 
 from blocks import Block
@@ -49,61 +52,266 @@ def v_gradient(y_start, y_end, x, y):
         return float(y - y_end) / (y_start - y_end)
 
 
-def generate_map(size):
-    """Return list of block ids in row-major order."""
-    blocks = []
+def noise_array(noise_func, x_scale, y_scale, xs, ys):
+    """Return normalized_noise at every point of arrays xs and ys.
     
+    This computes the same simplex noise as noise_func.noise2, with NumPy.
+    """
+    x = x_scale * xs.astype(float)
+    y = y_scale * ys.astype(float)
+    # skew input space to find which simplex (triangle) each point is in
+    s = (x + y) * perlin._F2
+    i = numpy.floor(x + s)
+    j = numpy.floor(y + s)
+    t = (i + j) * perlin._G2
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+    # lower triangle goes (0,0)->(1,0)->(1,1), upper (0,0)->(0,1)->(1,1)
+    i1 = (x0 > y0).astype(int)
+    j1 = 1 - i1
+    x1 = x0 - i1 + perlin._G2
+    y1 = y0 - j1 + perlin._G2
+    x2 = x0 + perlin._G2 * 2.0 - 1.0
+    y2 = y0 + perlin._G2 * 2.0 - 1.0
+    
+    # hashed gradients of the simplex corners
+    perm = numpy.array(noise_func.permutation)
+    grad = numpy.array([g[:2] for g in perlin._GRAD3[:12]], float)
+    ii = i.astype(int) % noise_func.period
+    jj = j.astype(int) % noise_func.period
+    corners = [(perm[ii + perm[jj]] % 12, x0, y0),
+               (perm[ii + i1 + perm[jj + j1]] % 12, x1, y1),
+               (perm[ii + 1 + perm[jj + 1]] % 12, x2, y2)]
+    
+    noise = numpy.zeros(x.shape)
+    for (gi, cx, cy) in corners:
+        tt = 0.5 - cx**2 - cy**2
+        noise += numpy.where(tt > 0, 
+                             tt**4 * (grad[gi, 0] * cx + grad[gi, 1] * cy), 
+                             0.0)
+    noise *= 70.0
+    return (noise * 127 + 128).astype(int) / 255.0
+
+
+def v_gradient_array(y_start, y_end, ys):
+    """Return v_gradient at every point of array ys."""
+    assert y_start > y_end
+    return numpy.clip((ys - y_end) / float(y_start - y_end), 0.0, 1.0)
+
+
+def seeded_noise(rng, period):
+    """Return a perlin.SimplexNoise with a permutation table from rng."""
+    perm = range(period)
+    rng.shuffle(perm)
+    return perlin.SimplexNoise(permutation_table=perm)
+
+
+class MapGenerator:
+    """Generates the blocks of a map from a seed.
+    
+    The terrain is a function of the seed and block position only, so any part
+    of the map can be generated on its own, in any order, and will match the
+    rest of the map.
+    
+    generate_block works out one block at a time. generate_array does the
+    same for a whole strip at once with NumPy arrays, and adds the seconds
+    spent in each stage to the timings dict.
+    """
     # tuneables
     HEIGHTMAP_X_SCALE = 0.04 # lower -> smoother terrian
     HEIGHTMAP_Y_SCALE = 0.04 # lower -> fewer overhangs and islands
     CAVE_SCALE = (0.1, 0.1)
     
-    # create noise functions
-    heightmap_noise = perlin.SimplexNoise(period=64)
-    cave_noise = perlin.SimplexNoise(period=64)
-    rock_noise = perlin.SimplexNoise(period=64)
-    
-    # y coordinate of highest block in each column of blocks
-    top_block_y = [size[1] - 1] * size[0]
-    
-    for y in xrange(size[1]):
-        for x in xrange(size[0]):
-            # ground heightmap
-            g = v_gradient(40, 20, x, y)
-            heightmap = normalized_noise(heightmap_noise, HEIGHTMAP_X_SCALE,
-                                         HEIGHTMAP_Y_SCALE, x, y)
-            g = threshold(g, heightmap)
-            
-            # caves, 1.0=cave
-            caves = normalized_noise(cave_noise, CAVE_SCALE[0], CAVE_SCALE[1],
-                                     x, y)
-            cave_freq = 1 - v_gradient(80, -60, x, y) # most caves at bottom
-            caves = add(caves, cave_freq)
-            caves = threshold(caves, 0.5)
-            
-            comp = sub(g, sub(1, caves))
-            
-            # rocks
-            rock = normalized_noise(rock_noise, 0.1, 0.1, x, y)
-            rock_freq = 1 - v_gradient(80, -100, x, y)
-            rock = add(rock, rock_freq)
-            rock = threshold(rock, 0.3)
-            
-            if comp == 1:
-                b = Block(name="dirt").id
-                if rock == 0:
-                    b = Block(name="rock").id
+    def __init__(self, seed=None):
+        """Create noise functions for the given seed (or a random seed)."""
+        if seed == None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        rng = random.Random(seed)
+        self.heightmap_noise = seeded_noise(rng, 64)
+        self.cave_noise = seeded_noise(rng, 64)
+        self.rock_noise = seeded_noise(rng, 64)
+        self.timings = {"noise": 0.0, "caves": 0.0, "rocks": 0.0, "grass": 0.0}
+    
+    def generate_block(self, x, y):
+        """Return the block id at (x, y), ignoring grass."""
+        # ground heightmap
+        g = v_gradient(40, 20, x, y)
+        heightmap = normalized_noise(self.heightmap_noise,
+                                     self.HEIGHTMAP_X_SCALE,
+                                     self.HEIGHTMAP_Y_SCALE, x, y)
+        g = threshold(g, heightmap)
+        
+        # caves, 1.0=cave
+        caves = normalized_noise(self.cave_noise, self.CAVE_SCALE[0],
+                                 self.CAVE_SCALE[1], x, y)
+        cave_freq = 1 - v_gradient(80, -60, x, y) # most caves at bottom
+        caves = add(caves, cave_freq)
+        caves = threshold(caves, 0.5)
+        
+        comp = sub(g, sub(1, caves))
+        
+        # rocks
+        rock = normalized_noise(self.rock_noise, 0.1, 0.1, x, y)
+        rock_freq = 1 - v_gradient(80, -100, x, y)
+        rock = add(rock, rock_freq)
+        rock = threshold(rock, 0.3)
+        
+        if comp == 1:
+            if rock == 0:
+                return Block.names["rock"]
+            return Block.names["dirt"]
+        return Block.names["air"]
+    
+    def generate_array(self, x_min, width, height):
+        """Return block ids of a strip of columns as an array by [y, x].
+        
+        The strip is width columns wide starting at x_min, and covers the full
+        height of the map, since grass depends on the blocks above it.
+        """
+        start = time()
+        (xs, ys) = numpy.meshgrid(numpy.arange(x_min, x_min + width), 
+                                  numpy.arange(height))
+        
+        # ground heightmap
+        heightmap = noise_array(self.heightmap_noise, self.HEIGHTMAP_X_SCALE, 
+                                self.HEIGHTMAP_Y_SCALE, xs, ys)
+        ground = v_gradient_array(40, 20, ys) > heightmap
+        start = self._time_stage("noise", start)
+        
+        # caves, True=cave
+        caves = noise_array(self.cave_noise, self.CAVE_SCALE[0], 
+                            self.CAVE_SCALE[1], xs, ys)
+        caves = caves + (1 - v_gradient_array(80, -60, ys)) > 0.5
+        start = self._time_stage("caves", start)
+        
+        # rocks, False=rock
+        rock = noise_array(self.rock_noise, 0.1, 0.1, xs, ys)
+        rock = rock + (1 - v_gradient_array(80, -100, ys)) > 0.3
+        
+        blocks = numpy.where(rock, Block.names["dirt"], Block.names["rock"])
+        blocks = numpy.where(ground & caves, blocks, Block.names["air"])
+        start = self._time_stage("rocks", start)
+        
+        # if the topmost non-air block of a column is dirt, make it grass
+        solid = blocks != Block.names["air"]
+        columns = numpy.flatnonzero(solid.any(axis=0))
+        tops = solid.argmax(axis=0)[columns]
+        top_dirt = blocks[tops, columns] == Block.names["dirt"]
+        blocks[tops[top_dirt], columns[top_dirt]] = Block.names["grass"]
+        self._time_stage("grass", start)
+        return blocks.astype(numpy.uint8)
+    
+    def _time_stage(self, stage, start):
+        """Add the time since start to a stage's timing and return the time."""
+        now = time()
+        self.timings[stage] += now - start
+        return now
+
+
+# state of BandGenerator worker processes
+_worker_blocks = None # shared array of the bands' block ids
+_worker_size = None
+
+
+def _init_worker(blocks, size):
+    """Set up a worker process to write to a shared array of block ids."""
+    global _worker_blocks, _worker_size
+    _worker_blocks = blocks
+    _worker_size = size
+
+
+def _generate_band(job):
+    """Generate a band of columns into the shared array.
+    
+    job is (seed, x_min, width, offset), where offset is the column of the
+    shared array the band starts at. Return the generator's timings.
+    """
+    (seed, x_min, width, offset) = job
+    generator = MapGenerator(seed)
+    band = generator.generate_array(x_min, width, _worker_size[1])
+    blocks = numpy.frombuffer(_worker_blocks, numpy.uint8)
+    blocks = blocks.reshape(_worker_size[1], _worker_size[0])
+    blocks[:, offset:offset + width] = band
+    return generator.timings
+
+
+class BandGenerator:
+    """A pool of worker processes generating bands of columns of a map.
+    
+    The workers generate the bands into an array in shared memory, which is
+    made with the pool and reused for every call to generate, so the worker
+    processes are only started once. Since the terrain only depends on the
+    seed and position, the result is the same for any number of workers.
+    
+    With one worker, the bands are generated in this process instead.
+    """
+    def __init__(self, seed, max_width, height, workers=1):
+        """Start workers for bands of up to max_width columns at a time."""
+        self.seed = seed
+        self.size = (max_width, height) # of the shared array
+        self._blocks = RawArray("B", max_width * height)
+        self._pool = None
+        if workers > 1:
+            self._pool = Pool(workers, _init_worker, (self._blocks, self.size))
+    
+    def generate(self, bands, timings=None):
+        """Return an array by [y, x] of the block ids of bands of columns.
+        
+        bands is a list of (x_min, width) bands, which are placed side by side
+        in the array in the same order.
+        
+        If timings is a dict, the seconds spent in each stage of generation,
+        summed over all the workers, are added to it.
+        """
+        parts = []
+        while bands:
+            # as many bands as fit in the shared array
+            (jobs, offset) = ([], 0)
+            while bands and offset + bands[0][1] <= self.size[0]:
+                (x_min, width) = bands[0]
+                jobs.append((self.seed, x_min, width, offset))
+                offset += width
+                bands = bands[1:]
+            assert jobs, "band wider than the shared array"
+            if self._pool != None and len(jobs) > 1:
+                results = self._pool.map(_generate_band, jobs)
             else:
-                b = Block(name="air").id
-            
-            # if this is the topmost non-air block, and it's dirt, make it grass
-            if y < top_block_y[x] and b != Block(name="air").id:
-                top_block_y[x] = y
-                if b == Block(name="dirt").id:
-                    b = Block(name="grass").id
-            
-            blocks.append(b)
-    return blocks
+                _init_worker(self._blocks, self.size)
+                results = map(_generate_band, jobs)
+                _init_worker(None, None)
+            if timings != None:
+                for result in results:
+                    for (stage, seconds) in result.items():
+                        timings[stage] = timings.get(stage, 0.0) + seconds
+            # copied, since the shared array is reused
+            blocks = numpy.frombuffer(self._blocks, numpy.uint8)
+            blocks = blocks.reshape(self.size[1], self.size[0])
+            parts.append(blocks[:, :offset].copy())
+        return numpy.hstack(parts)
+    
+    def close(self):
+        """Stop the worker processes."""
+        if self._pool != None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def generate_map(size, seed=None, workers=1, band_width=64, timings=None):
+    """Return list of block ids in row-major order.
+    
+    The map is split into bands of band_width columns which are generated
+    by a BandGenerator, so timings is as for BandGenerator.generate.
+    """
+    if seed == None:
+        seed = MapGenerator().seed
+    bands = [(x, min(band_width, size[0] - x)) 
+             for x in xrange(0, size[0], band_width)]
+    generator = BandGenerator(seed, size[0], size[1], min(workers, len(bands)))
+    blocks = generator.generate(bands, timings)
+    generator.close()
+    return blocks.ravel().tolist()
 
 
 def main():
@@ -114,18 +322,19 @@ def main():
     screen = pygame.display.set_mode(screen_size)
     blocks = pygame.Surface(blocks_size)
 
-    heightmap_noise = perlin.SimplexNoise(period=64)
-
-    m = generate_map(blocks_size)
+    timings = {}
+    m = generate_map(blocks_size, workers=cpu_count(), timings=timings)
+    for stage in ["noise", "caves", "rocks", "grass"]:
+        print "%s: %.3f s" % (stage, timings[stage])
 
-    cols = {Block(name="air").id: (0, 0, 255), 
-            Block(name="grass").id: (0, 255, 0), 
-            Block(name="rock").id: (100, 100, 100),
+    cols = {Block.names["air"]: (0, 0, 255), 
+            Block.names["grass"]: (0, 255, 0), 
+            Block.names["rock"]: (100, 100, 100),
            }
 
     for y in xrange(blocks_size[1]):
         for x in xrange(blocks_size[0]):
-            raw = m[x + y*blocks_size[1]]
+            raw = m[x + y*blocks_size[0]]
             col = cols[raw]
             blocks.set_at((x,y), col)
     
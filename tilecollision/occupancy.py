@@ -0,0 +1,87 @@
+import binascii
+import numpy
+
+from blocks import IS_SOLID
+
+
+class SolidRows:
+    """Bitmasks of the solid blocks in each row of the map.
+
+    Bit x of a row's mask is set if the block at x is solid, so whether a
+    rect contains any solid blocks takes one AND per row, however wide it is.
+    The masks must be kept up to date by calling set_solid whenever a block
+    changes.
+
+    For looking up many blocks at once, solid_at uses a NumPy bool array which
+    is unpacked from the masks when they have changed since it was last used.
+
+    Only the columns of loaded chunks are included. Blocks in other columns
+    and outside the map count as not solid.
+    """
+    def __init__(self, map_blocks):
+        """Create empty masks for the given Map."""
+        self.map_blocks = map_blocks
+        self.rows = [0] * map_blocks.size[1] # y -> mask of solid x
+        self._solid = None # [y, x] -> block is solid, or None if out of date
+
+    def load_column(self, x):
+        """Add the solid blocks of column x from the map's blocks."""
+        bit = 1 << x
+        for y in xrange(len(self.rows)):
+            if IS_SOLID[self.map_blocks.get_block(x, y)]:
+                self.rows[y] |= bit
+        self._solid = None
+
+    def unload_column(self, x):
+        """Forget the solid blocks of column x."""
+        mask = ~(1 << x)
+        for y in xrange(len(self.rows)):
+            self.rows[y] &= mask
+        self._solid = None
+
+    def set_solid(self, x, y, is_solid):
+        """Record whether the block at (x, y) is solid."""
+        row = self.rows[y]
+        if is_solid:
+            self.rows[y] |= 1 << x
+        else:
+            self.rows[y] &= ~(1 << x)
+        if self.rows[y] != row:
+            self._solid = None
+
+    def any_solid(self, x_min, y_min, x_max, y_max):
+        """Return True if any block in a rect of the map is solid.
+
+        The rect covers x_min to x_max and y_min to y_max, excluding the max
+        coordinates.
+        """
+        x_min = max(x_min, 0)
+        if x_max <= x_min:
+            return False
+        mask = ((1 << (x_max - x_min)) - 1) << x_min
+        for y in xrange(max(y_min, 0), min(y_max, len(self.rows))):
+            if self.rows[y] & mask:
+                return True
+        return False
+
+    def solid_at(self, xs, ys):
+        """Return a bool array of whether each block in int arrays is solid."""
+        if self._solid is None:
+            self._solid = self._unpack_rows()
+        (height, width) = self._solid.shape
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        result = numpy.zeros(xs.shape, numpy.bool_)
+        result[inside] = self._solid[ys[inside], xs[inside]]
+        return result
+
+    def _unpack_rows(self):
+        """Return a bool array by [y, x] of the bits of the row masks."""
+        width = self.map_blocks.size[0]
+        num_bytes = (width + 7) / 8
+        # each mask as big-endian bytes, so bit x ends up at column x once the
+        # unpacked bits are reversed
+        data = "".join(binascii.unhexlify("%0*x" % (2 * num_bytes, row))
+                       for row in self.rows)
+        bits = numpy.unpackbits(numpy.frombuffer(data, numpy.uint8).reshape(
+                len(self.rows), num_bytes), axis=1)
+        return bits[:, ::-1][:, :width].astype(numpy.bool_)
@@ -1,22 +1,103 @@
+import numpy
 import pygame
 from sys import exit
-from random import uniform, randrange
 
 
-class Particle:
-    """Data structure for one particle."""
-    def __init__(self, x, y, dx, dy, max_age, surf_rect):
-        self.x = x
-        self.y = y
-        self.dx = dx
-        self.dy = dy
-        self.age = 0
-        self.max_age = max_age
-        self.surf_rect = surf_rect
+class ParticlePool:
+    """Every live particle, stored in NumPy arrays of a fixed capacity.
+
+    Particle i is row i of each array, and the first count rows are the live
+    particles. update moves all of them at once and packs the ones still
+    alive into the start of the arrays, so many particle systems cost about
+    the same as one. When the pool is full, new particles are dropped.
+
+    Each particle is a small square cut from a source surface, and they are
+    all drawn with one Surface.blits call.
+    """
+    def __init__(self, capacity=4096):
+        """Create an empty pool with room for capacity particles."""
+        self.size = 5 # pixels square
+        self.gravity = 100.0 # pixels/sec/sec
+
+        self.capacity = capacity
+        self.count = 0 # number of live particles
+        self.x = numpy.zeros(capacity) # pixels
+        self.y = numpy.zeros(capacity)
+        self.dx = numpy.zeros(capacity) # pixels/sec
+        self.dy = numpy.zeros(capacity)
+        self.age = numpy.zeros(capacity) # ms
+        self.max_age = numpy.zeros(capacity) # ms
+        # topleft of the particle's square in its source surface
+        self.src_x = numpy.zeros(capacity, numpy.int32)
+        self.src_y = numpy.zeros(capacity, numpy.int32)
+        self.source = numpy.zeros(capacity, numpy.int32) # index in _sources
+
+        self._sources = [] # surfaces particles are cut from
+        self._source_ids = {} # surface -> index in _sources
+
+    def spawn(self, num, pos, source_surf, v_range, life_range):
+        """Add up to num particles at pixel pos.
+
+        Each particle gets a random velocity in v_range pixels/sec along each
+        axis, a random lifetime in life_range ms, and a random square of
+        source_surf.
+        """
+        num = min(num, self.capacity - self.count)
+        if num <= 0:
+            return
+        if source_surf not in self._source_ids:
+            self._source_ids[source_surf] = len(self._sources)
+            self._sources.append(source_surf)
+        new = slice(self.count, self.count + num)
+        (width, height) = source_surf.get_size()
+        self.x[new] = pos[0]
+        self.y[new] = pos[1]
+        self.dx[new] = numpy.random.uniform(v_range[0], v_range[1], num)
+        self.dy[new] = numpy.random.uniform(v_range[0], v_range[1], num)
+        self.age[new] = 0
+        self.max_age[new] = numpy.random.uniform(life_range[0],
+                                                 life_range[1], num)
+        self.src_x[new] = numpy.random.randint(0, width - self.size, num)
+        self.src_y[new] = numpy.random.randint(0, height - self.size, num)
+        self.source[new] = self._source_ids[source_surf]
+        self.count += num
+
+    def update(self, millis):
+        """Remove dead particles and move the rest."""
+        live = slice(0, self.count)
+        alive = self.age[live] <= self.max_age[live]
+        if not alive.all():
+            self.count = numpy.count_nonzero(alive)
+            for array in [self.x, self.y, self.dx, self.dy, self.age,
+                          self.max_age, self.src_x, self.src_y, self.source]:
+                array[:self.count] = array[live][alive]
+            live = slice(0, self.count)
+        secs = millis / 1000.0
+        self.dy[live] += self.gravity * secs
+        self.x[live] += self.dx[live] * secs
+        self.y[live] += self.dy[live] * secs
+        self.age[live] += millis
+
+    def draw(self, surf, offset):
+        """Draw the particles to surf, moved by the pixel offset."""
+        live = slice(0, self.count)
+        x = self.x[live] + offset[0]
+        y = self.y[live] + offset[1]
+        (width, height) = surf.get_size()
+        visible = ((x > -self.size) & (x < width) &
+                   (y > -self.size) & (y < height))
+        size = self.size
+        sources = self._sources
+        surf.blits([(sources[source], (px, py), (sx, sy, size, size))
+                    for (px, py, sx, sy, source) in zip(
+                            x[visible].tolist(), y[visible].tolist(),
+                            self.src_x[live][visible].tolist(),
+                            self.src_y[live][visible].tolist(),
+                            self.source[live][visible].tolist())], False)
 
 
 class ParticleSystem:
-    """A source of particles."""
+    """A source of particles, which are added to a ParticlePool."""
     def __init__(self, source_surf=pygame.image.load('grass.png')):
         """Init and set parameters.
         
@@ -24,50 +105,28 @@ class ParticleSystem:
         """
         self.duration = 250 # ms
         self.spawn_rate = 0.1 # particles/ms
-        self.gravity = 100.0 # units/sec/sec
         self.source_surf = source_surf
-        self.surf_size = self.source_surf.get_size()
-        self.size = 5
         self.v_range = (-80, 80)
         self.life_range = (100, 1000) # ms
         
         self.age = 0
-        self.particles = []
-        
+    
     def is_expired(self):
-        """Return true if expired."""
-        return (self.age > self.duration) and (len(self.particles) == 0)
+        """Return true if it has stopped spawning particles."""
+        return self.age > self.duration
     
-    def update(self, millis):
-        """Update particle positions and spawn new particles."""
-        # update particle positions
-        for p in self.particles:
-            if p.age > p.max_age:
-                self.particles.remove(p)
-            else:
-                p.dy += self.gravity * millis/1000
-                p.x += p.dx * millis/1000
-                p.y += p.dy * millis/1000
-                p.age += millis
+    def update(self, millis, pool, pos, spawn_millis=None):
+        """Age by millis and spawn new particles into pool at pixel pos.
         
-        # spawn new particles
+        spawn_millis is how many ms worth of particles to spawn, if it isn't
+        millis.
+        """
+        if spawn_millis == None:
+            spawn_millis = millis
         self.age += millis
         if self.age < self.duration:
-            num_new = int(self.spawn_rate * millis)
-            for i in xrange(num_new):
-                surf_rect = (randrange(0, self.surf_size[0] - self.size),
-                             randrange(0, self.surf_size[1] - self.size))
-                p = Particle(0.0, 0.0, uniform(*self.v_range), 
-                             uniform(*self.v_range), 
-                             uniform(*self.life_range), surf_rect)
-                self.particles.append(p)
-
-    def draw(self, surf, pos):
-        """Draw the particles to surf centered at pos."""
-        for p in self.particles:
-            rect = (p.x + pos[0], p.y + pos[1], self.size, self.size)
-            surf.blit(self.source_surf, rect, (p.surf_rect[0], p.surf_rect[1],
-                                               self.size, self.size))
+            pool.spawn(int(self.spawn_rate * spawn_millis), pos, 
+                       self.source_surf, self.v_range, self.life_range)
 
 
 def main():
@@ -77,14 +136,16 @@ def main():
     screen = pygame.display.set_mode(screen_size)
     
     s2 = pygame.Surface(screen_size, pygame.SRCALPHA)
+    pool = ParticlePool()
     ps = ParticleSystem()
 
     while True:
         
         # draw
         s2.fill((0,0,0))
-        ps.update(16)
-        ps.draw(s2, (300,300))
+        pool.update(16)
+        ps.update(16, pool, (300,300))
+        pool.draw(s2, (0,0))
         
         screen.blit(s2, (0,0))
         pygame.display.flip()
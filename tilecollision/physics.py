@@ -0,0 +1,244 @@
+import numpy
+
+
+class EntityPhysics:
+    """Positions, velocities and controls of many entities, kept in arrays.
+
+    Each entity is a row of every array in fields, so update can move all of
+    them at once with NumPy instead of one at a time. Entities are added and
+    removed with add and remove. Removing an entity moves the last one into
+    its row, so each entity's row is kept in its index attribute.
+
+    Entities move along x and then y. Each move is swept across the tile
+    grid, stopping at the first solid block in the way, so entities can't
+    pass through blocks however fast they move or however long the timestep
+    is. Hitting a block only stops movement along that axis, so entities
+    slide along surfaces.
+
+    After each update, overlaps is a list of (entity, entity) pairs whose
+    rects overlap, found by sorting the entities by their left edges.
+    """
+    # name -> (dtype, default)
+    FIELDS = {
+        "x": (numpy.float64, 0.0),
+        "y": (numpy.float64, 0.0),
+        "width": (numpy.float64, 1.0),
+        "height": (numpy.float64, 1.0),
+        "dx": (numpy.float64, 0.0), # block/sec
+        "dy": (numpy.float64, 0.0), # block/sec
+        "is_falling": (numpy.bool_, True), # whether the entity is in the air
+        "grav_a": (numpy.float64, 5.0), # blocks/sec/sec
+        "max_fall": (numpy.float64, 10.0), # block/sec
+        "jump_v": (numpy.float64, -4.5), # block/sec
+        "walk_a": (numpy.float64, 6.0), # blocks/sec/sec
+        "max_walk": (numpy.float64, 6.0), # block/sec
+        # actions entity can be trying to do
+        "walk_left": (numpy.bool_, False),
+        "walk_right": (numpy.bool_, False),
+        "jump": (numpy.bool_, False),
+    }
+
+    def __init__(self):
+        """Create an empty set of entities."""
+        self.SWEEP_EPSILON = 1e-6 # blocks an edge can be off a grid line
+
+        self.entities = [] # entity in each row
+        self.fields = dict((name, numpy.empty(16, dtype))
+                           for (name, (dtype, default))
+                           in self.FIELDS.iteritems())
+        self.time = 0.0 # ms of updates so far
+        self.overlaps = []
+
+    def add(self, entity, **values):
+        """Add a row for entity, with field values given by keyword.
+
+        Fields which aren't given get their defaults. entity.index is set to
+        the row.
+        """
+        index = len(self.entities)
+        capacity = len(self.fields["x"])
+        if index == capacity:
+            for (name, array) in self.fields.items():
+                self.fields[name] = numpy.resize(array, 2 * capacity)
+        for (name, (dtype, default)) in self.FIELDS.iteritems():
+            self.fields[name][index] = values.pop(name, default)
+        if values:
+            raise TypeError("unknown fields: %s" % ", ".join(values))
+        self.entities.append(entity)
+        entity.index = index
+
+    def remove(self, entity):
+        """Remove entity's row, moving the last entity into it."""
+        last = len(self.entities) - 1
+        moved = self.entities.pop()
+        if moved is not entity:
+            for array in self.fields.itervalues():
+                array[entity.index] = array[last]
+            self.entities[entity.index] = moved
+            moved.index = entity.index
+        entity.index = None
+
+    def get(self, index, name):
+        """Return the value of a field for the entity in a row."""
+        return self.fields[name][index].item()
+
+    def set(self, index, name, value):
+        """Set the value of a field for the entity in a row."""
+        self.fields[name][index] = value
+
+    def get_chunks(self, chunk_size):
+        """Return (x, y) arrays of the chunk each entity's center is in.
+
+        Chunks are given by their topleft block, for square chunks of
+        chunk_size blocks.
+        """
+        n = len(self.entities)
+        f = self.fields
+        return tuple(numpy.floor((f[pos][:n] + f[size][:n] / 2) / 
+                                 chunk_size).astype(int) * chunk_size
+                     for (pos, size) in [("x", "width"), ("y", "height")])
+
+    def update(self, millis, solid_rows, rows=None, steps=1):
+        """Apply gravity and controls, then move and collide the entities.
+
+        solid_rows is the map's SolidRows. rows is an array of the rows to
+        update, or None to update every entity. Entities which are updated
+        less often can be moved by several updates' worth of time at once by
+        giving the number of updates as steps, either one number or an array
+        with one for each of rows.
+        """
+        self.time += millis
+        n = len(self.entities)
+        if rows is None:
+            f = dict((name, array[:n]) for (name, array) 
+                     in self.fields.items())
+        else:
+            f = dict((name, array[rows]) for (name, array) 
+                     in self.fields.items())
+        secs = numpy.empty(len(f["x"]))
+        secs[:] = steps * millis / 1000.0
+
+        # apply gravity
+        falling = f["is_falling"]
+        # have to keep some small dy so we can start falling
+        f["dy"][:] = numpy.where(falling, numpy.minimum(
+                f["dy"] + f["grav_a"] * secs, f["max_fall"]), 0.01)
+
+        # apply jumping
+        jumping = ~falling & f["jump"]
+        f["dy"][jumping] = f["jump_v"][jumping]
+        falling |= jumping
+
+        # apply walking
+        right = f["walk_right"] & ~f["walk_left"]
+        left = f["walk_left"] & ~f["walk_right"]
+        dx = f["dx"]
+        dx[right] += f["walk_a"][right] * secs[right]
+        dx[left] -= f["walk_a"][left] * secs[left]
+        too_fast = numpy.abs(dx) > f["max_walk"]
+        dx[right & too_fast] = f["max_walk"][right & too_fast]
+        dx[left & too_fast] = -f["max_walk"][left & too_fast]
+        dx[~right & ~left] = 0 # stop instantly?
+
+        # move in x, stopping against any block in the way
+        (moved, x_collision) = self._sweep(solid_rows, f, 0, dx * secs)
+        f["x"] += moved
+        dx[x_collision] = 0
+
+        # move in y, stopping against any block in the way
+        y_increasing = f["dy"] > 0 # entity is falling
+        (moved, y_collision) = self._sweep(solid_rows, f, 1, f["dy"] * secs)
+        f["y"] += moved
+        falling[y_increasing] = ~y_collision[y_increasing]
+        # bumped head, so loose vertical velocity
+        f["dy"][~y_increasing & y_collision] = 0
+
+        if rows is not None:
+            for (name, array) in self.fields.iteritems():
+                array[rows] = f[name]
+        self.overlaps = self._find_overlaps(
+                dict((name, array[:n]) for (name, array) 
+                     in self.fields.items()))
+
+    def _sweep(self, solid_rows, f, axis, distance):
+        """Return (moved, hit) arrays for moving every entity along an axis.
+
+        axis is 0 to move distance blocks in x or 1 to move in y. moved is
+        distance where nothing is in the way, otherwise the distance to the
+        edge of the first solid block, where hit is True.
+
+        The rows or columns of blocks that each entity's leading edge crosses
+        are checked in order, one step for every entity at a time. Edges
+        within SWEEP_EPSILON of a grid line count as on it, so rounding
+        doesn't make an entity that was stopped against a block overlap it.
+        """
+        eps = self.SWEEP_EPSILON
+        (pos_name, size_name) = [("x", "width"), ("y", "height")][axis]
+        (across_name, across_size_name) = [("x", "width"),
+                                           ("y", "height")][1 - axis]
+        (pos, size) = (f[pos_name], f[size_name])
+        # blocks covered across the direction of movement
+        across_min = numpy.floor(f[across_name] + eps).astype(int)
+        across_max = numpy.ceil(f[across_name] + f[across_size_name] -
+                                eps).astype(int)
+
+        forward = distance > 0
+        edge = numpy.where(forward, pos + size, pos)
+        step = numpy.where(forward, 1, -1)
+        first = numpy.where(forward, numpy.ceil(edge - eps),
+                            numpy.floor(edge + eps) - 1).astype(int)
+        end = numpy.where(forward, numpy.ceil(edge + distance - eps),
+                          numpy.floor(edge + distance + eps) - 1).astype(int)
+        num_lines = (end - first) * step
+
+        moved = distance.copy()
+        hit = numpy.zeros(len(distance), numpy.bool_)
+        active = numpy.flatnonzero(num_lines > 0)
+        i = 0
+        while len(active) > 0:
+            line = first[active] + i * step[active]
+            # check the blocks of the line across each entity
+            line_hit = numpy.zeros(len(active), numpy.bool_)
+            across = across_min[active]
+            across_end = across_max[active]
+            while True:
+                inside = across < across_end
+                if not inside.any():
+                    break
+                if axis == 0:
+                    line_hit |= inside & solid_rows.solid_at(line, across)
+                else:
+                    line_hit |= inside & solid_rows.solid_at(across, line)
+                across = across + 1
+            stopped = active[line_hit]
+            moved[stopped] = numpy.where(forward[stopped],
+                                         line[line_hit] - edge[stopped],
+                                         line[line_hit] + 1 - edge[stopped])
+            hit[stopped] = True
+            i += 1
+            active = active[~line_hit & (num_lines[active] > i)]
+        return (moved, hit)
+
+    def _find_overlaps(self, f):
+        """Return (entity, entity) pairs of every two overlapping entities.
+
+        After sorting by left edge, the only entities that can overlap one
+        are the ones after it whose left edges are left of its right edge.
+        """
+        order = numpy.argsort(f["x"], kind="mergesort")
+        left = f["x"][order]
+        right = left + f["width"][order]
+        ends = numpy.searchsorted(left, right)
+        counts = numpy.maximum(ends - numpy.arange(len(order)) - 1, 0)
+        if not counts.any():
+            return []
+        # every candidate pair (i, j) of sorted positions with i < j
+        i = numpy.repeat(numpy.arange(len(order)), counts)
+        starts = numpy.cumsum(counts) - counts
+        j = i + 1 + numpy.arange(len(i)) - numpy.repeat(starts, counts)
+        (a, b) = (order[i], order[j])
+        top = f["y"]
+        bottom = f["y"] + f["height"]
+        overlapping = (top[a] < bottom[b]) & (top[b] < bottom[a])
+        return [(self.entities[ea], self.entities[eb]) for (ea, eb)
+                in zip(a[overlapping], b[overlapping])]
@@ -0,0 +1,163 @@
+import numpy
+import pygame
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from blocks import LIT_SURFS, MAX_LIGHT_LEVEL
+
+
+def rasterize(tiles, ids, levels):
+    """Return the pixel array of a chunk.
+
+    tiles: array of tile pixels indexed by [block id, light level, x, y, rgb].
+    ids, levels: arrays of the chunk's block ids and light levels by [x, y].
+
+    The result is indexed by [x, y, rgb] like pygame.surfarray.
+    """
+    (chunk_w, chunk_h) = ids.shape
+    (tile_w, tile_h) = tiles.shape[2:4]
+    # [tile x, tile y, pixel x, pixel y] -> [tile x, pixel x, tile y, pixel y]
+    pixels = tiles[ids, levels].transpose(0, 2, 1, 3, 4)
+    return pixels.reshape(chunk_w * tile_w, chunk_h * tile_h, 3)
+
+
+class _Finished:
+    """Stands in for the AsyncResult of work which was done right away."""
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
+class ChunkRasterizer:
+    """Renders chunks of map tiles to pixels with NumPy on worker threads.
+
+    A chunk is rendered by looking up the pixels of every tile in a table of
+    all the block surfaces at every light level, which NumPy does without
+    holding the GIL. Work is submitted with a snapshot of the chunk's block
+    ids and light levels, so the map can keep changing while the workers run.
+
+    Chunks submitted together make up a batch, and finished chunks are only
+    handed back once their whole batch is done, in the order the batches were
+    submitted. So all the chunks changed by an edit appear at the same time.
+
+    Chunks with one kind of block at one light level all look the same, so
+    their pixels are cached and reused instead of being rendered.
+    """
+    def __init__(self, map, workers):
+        """Create a rasterizer for Map tiles with a pool of workers."""
+        self.map = map
+        self.EMPTY = len(LIT_SURFS) # id used for blocks outside the map
+        self._tiles = None # created on first use
+        self._pool = ThreadPool(workers)
+        self._batch = [] # (pos, version, AsyncResult) being submitted
+        self._batches = deque() # batches waiting for results
+        self._patterns = {} # (block id, light level) -> pixels of a chunk
+
+    def _make_tiles(self):
+        """Create the table of tile pixels for every block and light level."""
+        size = self.map.TILE_SIZE
+        tiles = numpy.zeros((self.EMPTY + 1, MAX_LIGHT_LEVEL + 1, size, size,
+                             3), numpy.uint8)
+        surf = pygame.Surface((size, size), 0, 32)
+        for bid in xrange(self.EMPTY + 1):
+            for level in xrange(MAX_LIGHT_LEVEL + 1):
+                # draw tile the same way as Map.draw_chunk
+                surf.fill(self.map.BACKGROUND_COLOR)
+                if bid != self.EMPTY:
+                    surf.blit(LIT_SURFS[bid][level], (0, 0))
+                tiles[bid, level] = pygame.surfarray.array3d(surf)
+        self._tiles = tiles
+
+    def snapshot(self, pos):
+        """Return copies of the block ids and light levels of a chunk.
+
+        In overlay mode the chunk is rendered fully lit.
+        """
+        size = self.map.CHUNK_SIZE
+        ids = numpy.empty((size, size), numpy.uint8)
+        ids.fill(self.EMPTY)
+        levels = numpy.empty((size, size), numpy.uint8)
+        levels.fill(MAX_LIGHT_LEVEL)
+        chunk = self.map.get_chunk(*pos)
+        if chunk != None:
+            (w, h) = chunk.size
+            if chunk.blocks.get_uniform() != None:
+                ids[:w, :h] = chunk.blocks.get_uniform()
+            else:
+                cells = numpy.frombuffer(chunk.blocks.cells, numpy.uint8)
+                ids[:w, :h] = cells.reshape(h, w).T
+            if not self.map.LIGHT_OVERLAY:
+                for x in xrange(w):
+                    for y in xrange(h):
+                        levels[x, y] = self.map.light.get_visible_light(
+                                pos[0] + x, pos[1] + y)
+        return (ids, levels)
+
+    def _get_pattern(self, ids, levels):
+        """Return the cached pixels of a chunk, or None if it's not uniform.
+
+        A chunk is uniform if it has one kind of block at one light level.
+        """
+        if ids.min() != ids.max() or levels.min() != levels.max():
+            return None
+        key = (ids[0, 0], levels[0, 0])
+        if key not in self._patterns:
+            self._patterns[key] = rasterize(self._tiles, ids, levels)
+        return self._patterns[key]
+
+    def render(self, surf, pos):
+        """Render the chunk at pos to surf right away."""
+        if self._tiles is None:
+            self._make_tiles()
+        (ids, levels) = self.snapshot(pos)
+        pixels = self._get_pattern(ids, levels)
+        if pixels is None:
+            pixels = rasterize(self._tiles, ids, levels)
+        pygame.surfarray.blit_array(surf, pixels)
+
+    def submit(self, pos, version):
+        """Start rendering the chunk at pos in the background.
+
+        version is handed back with the result to tell it apart from other
+        renders of the same chunk.
+        """
+        if self._tiles is None:
+            self._make_tiles()
+        (ids, levels) = self.snapshot(pos)
+        pixels = self._get_pattern(ids, levels)
+        if pixels is None:
+            result = self._pool.apply_async(rasterize,
+                                            (self._tiles, ids, levels))
+        else:
+            result = _Finished(pixels)
+        self._batch.append((pos, version, result))
+
+    def end_batch(self):
+        """Finish the batch of chunks submitted since the last call."""
+        if self._batch:
+            self._batches.append(self._batch)
+            self._batch = []
+
+    def pending(self):
+        """Return the number of chunks submitted but not handed back."""
+        return len(self._batch) + sum(len(b) for b in self._batches)
+
+    def completed(self):
+        """Return (pos, version, upload) for each chunk of finished batches.
+
+        upload(surf) copies the rendered pixels to a surface.
+        """
+        done = []
+        while self._batches and all(r.ready() for (p, v, r) in
+                                    self._batches[0]):
+            for (pos, version, result) in self._batches.popleft():
+                pixels = result.get()
+                upload = lambda surf, pixels=pixels: \
+                    pygame.surfarray.blit_array(surf, pixels)
+                done.append((pos, version, upload))
+        return done
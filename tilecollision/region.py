@@ -0,0 +1,164 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from chunks import Chunk
+from grid import Grid
+
+
+class Region:
+    """A file storing the block ids of a square of chunks.
+
+    The file starts with a header, which is the magic string followed by an
+    index entry for each chunk in the region:
+
+        offset (uint32), length (uint32), compressed (uint8),
+        width (uint8), height (uint8), padding (uint8)
+
+    An offset of 0 means the chunk hasn't been saved. The record for a chunk is
+    its block ids, one byte each in row-major order, and is optionally
+    compressed with zlib. Light levels aren't saved, since they are computed
+    from the blocks when a chunk is loaded.
+
+    The file is memory-mapped, so opening a region only reads the header, and
+    reading a chunk only touches the pages its record is in. A record is
+    rewritten in place if the new one fits, otherwise it is appended to the
+    end of the file. Uncompressed records are always the same size, so they
+    are always rewritten in place.
+    """
+    MAGIC = "TCR2" # changes with the format
+    ENTRY = struct.Struct("<IIBBBx")
+
+    def __init__(self, path, num_chunks):
+        """Open the region file at path, creating it if needed."""
+        self.path = path
+        self.num_chunks = num_chunks
+        self.header_size = len(self.MAGIC) + self.ENTRY.size * num_chunks
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(self.MAGIC)
+                f.write("\0" * (self.header_size - len(self.MAGIC)))
+        self._file = open(path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(self.MAGIC)] != self.MAGIC:
+            self.close()
+            raise ValueError("%s isn't a region file of this version" % path)
+
+    def _entry_pos(self, index):
+        """Return the position of the index entry of a chunk in the file."""
+        return len(self.MAGIC) + index * self.ENTRY.size
+
+    def read_chunk(self, index):
+        """Return the Grid of a chunk's blocks, or None if not saved."""
+        (offset, length, compressed, width, height) = self.ENTRY.unpack_from(
+                self._map, self._entry_pos(index))
+        if offset == 0:
+            return None
+        if offset + length > len(self._map):
+            # the record was appended since the file was mapped
+            self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        data = self._map[offset:offset + length]
+        if compressed:
+            data = zlib.decompress(data)
+        return Grid((width, height), data=data)
+
+    def write_chunk(self, index, blocks, compress):
+        """Save the Grid of a chunk's blocks."""
+        data = str(blocks.cells)
+        if compress:
+            data = zlib.compress(data)
+        (offset, length) = self.ENTRY.unpack_from(
+                self._map, self._entry_pos(index))[:2]
+        if offset == 0 or len(data) > length:
+            # doesn't fit in the old record, so append a new one
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+        self._file.seek(offset)
+        self._file.write(data)
+        self._file.seek(self._entry_pos(index))
+        self._file.write(self.ENTRY.pack(offset, len(data), compress,
+                                         blocks.width, blocks.height))
+        self._file.flush()
+
+    def close(self):
+        """Close the region file."""
+        self._map.close()
+        self._file.close()
+
+
+class RegionStore:
+    """Saves and loads chunks to a directory of Region files.
+
+    Each region file holds a REGION_SIZE square of chunks. Region files are
+    opened when first needed and kept open. Other information about the map,
+    like its seed, is kept in a small JSON file.
+    """
+    REGION_SIZE = 16 # chunks square
+
+    def __init__(self, path, chunk_size, compress=True):
+        """Use the directory at path to store chunks of chunk_size blocks."""
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compress = compress
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._regions = {} # (rx, ry) -> Region
+
+    def read_info(self):
+        """Return the dict saved by write_info, or None if there isn't one."""
+        info_path = os.path.join(self.path, "world.json")
+        if not os.path.exists(info_path):
+            return None
+        with open(info_path) as f:
+            return json.load(f)
+
+    def write_info(self, info):
+        """Save a dict of information about the map."""
+        with open(os.path.join(self.path, "world.json"), "w") as f:
+            json.dump(info, f)
+
+    def _locate(self, pos, create):
+        """Return (Region, index) for the chunk with topleft block pos.
+
+        If the region file doesn't exist and create is False, the Region is
+        None.
+        """
+        (cx, cy) = (pos[0] / self.chunk_size, pos[1] / self.chunk_size)
+        (rx, ry) = (cx / self.REGION_SIZE, cy / self.REGION_SIZE)
+        if (rx, ry) not in self._regions:
+            region_path = os.path.join(self.path, "r.%i.%i.region" % (rx, ry))
+            if not create and not os.path.exists(region_path):
+                return (None, None)
+            self._regions[(rx, ry)] = Region(region_path,
+                                             self.REGION_SIZE ** 2)
+        index = ((cy % self.REGION_SIZE) * self.REGION_SIZE +
+                 cx % self.REGION_SIZE)
+        return (self._regions[(rx, ry)], index)
+
+    def load_chunk(self, pos):
+        """Return the saved Chunk with topleft block pos, or None.
+
+        Light starts at 0, to be computed from the blocks.
+        """
+        (region, index) = self._locate(pos, False)
+        if region == None:
+            return None
+        blocks = region.read_chunk(index)
+        if blocks == None:
+            return None
+        return Chunk(pos, blocks)
+
+    def save_chunk(self, chunk):
+        """Save a Chunk."""
+        (region, index) = self._locate(chunk.pos, True)
+        region.write_chunk(index, chunk.blocks, self.compress)
+
+    def close(self):
+        """Close all open region files."""
+        for region in self._regions.values():
+            region.close()
+        self._regions = {}
@@ -0,0 +1,189 @@
+from time import time
+
+
+class RenderScheduler:
+    """Decides when the chunks of a ChunkCache are rendered.
+
+    Only visible chunks that aren't cached are rendered right away, by get.
+    Invalidated chunks keep their old surface until they are re-rendered, and
+    chunks likely to come on screen soon are rendered before they are needed.
+    Both of these happen in run, which stops when its time is up.
+
+    If a ChunkRasterizer is given, run submits chunks to it to be rendered in
+    the background instead, and uploads finished chunks on later calls. A
+    finished chunk is only used if it hasn't been invalidated since it was
+    submitted.
+
+    If a patch_func is given, invalidations can name the blocks which changed.
+    A chunk with at most max_patch changed blocks is patched by redrawing just
+    those blocks into its cached surface, on the main thread, instead of
+    being re-rendered.
+    """
+    def __init__(self, cache, draw_func, rasterizer=None, max_pending=16,
+                 patch_func=None, max_patch=0):
+        """Schedule renders into a ChunkCache using draw_func(surf, pos).
+
+        max_pending limits the number of chunks submitted to the rasterizer
+        at once. patch_func(surf, pos, blocks) redraws a list of blocks of the
+        chunk at pos.
+        """
+        self.cache = cache
+        self.draw_func = draw_func
+        self.rasterizer = rasterizer
+        self.max_pending = max_pending
+        self.patch_func = patch_func
+        self.max_patch = max_patch
+        # cached chunks which need re-rendering -> set of changed blocks, or
+        # None if the whole chunk needs it
+        self._dirty = {}
+        # chunks submitted to the rasterizer -> version submitted, and the
+        # number of times they have been invalidated since, which is only
+        # kept while they're in flight so the dicts don't grow
+        self._in_flight = {}
+        self._version = {}
+        self.updated = set() # chunks whose surfaces changed, for the caller
+
+        self.blocking_renders = 0 # renders done by get
+        self.background_renders = 0 # renders done by run
+        self.patches = 0 # chunks patched by run
+
+    def invalidate(self, pos, blocks=None):
+        """Mark the chunk at pos as needing to be re-rendered.
+
+        blocks is a list of the blocks which changed, or None if unknown.
+        """
+        self._invalidate_in_flight(pos)
+        if pos not in self.cache:
+            return
+        if blocks == None or self.patch_func == None:
+            self._dirty[pos] = None
+            return
+        dirty = self._dirty.setdefault(pos, set())
+        if dirty != None:
+            dirty.update(blocks)
+            if len(dirty) > self.max_patch:
+                self._dirty[pos] = None # cheaper to draw the whole chunk
+
+    def discard(self, pos):
+        """Throw away the cached surface of the chunk at pos."""
+        self._invalidate_in_flight(pos)
+        self.cache.discard(pos)
+        self._dirty.pop(pos, None)
+
+    def _invalidate_in_flight(self, pos):
+        """Make sure a render of pos in the rasterizer won't be used."""
+        if pos in self._in_flight:
+            self._version[pos] = self._version.get(pos, 0) + 1
+
+    def get(self, pos):
+        """Return the surface of a visible chunk, rendering it if missing.
+
+        The surface may be out of date if the chunk was invalidated.
+        """
+        surf = self.cache.get(pos)
+        if surf == None:
+            surf = self._render(pos)
+            self.blocking_renders += 1
+        return surf
+
+    def peek(self, pos):
+        """Return the cached surface of a chunk, or None if it's missing.
+
+        Unlike get, a missing chunk is left for run to render.
+        """
+        return self.cache.peek(pos)
+
+    def run(self, deadline, visible, prefetch, focus):
+        """Render chunks in order of priority until time() reaches deadline.
+
+        visible: positions of chunks on screen.
+        prefetch: positions of chunks which are likely to be on screen soon.
+        focus: grid position the player is heading towards.
+
+        Invalidated chunks on screen come first, then invalidated and missing
+        chunks which might be on screen soon, closest to focus first. Other
+        invalidated chunks are thrown away instead of being re-rendered. At
+        least one chunk is rendered if any need it.
+
+        Chunks which can be patched are patched first, and aren't sent to the
+        rasterizer.
+        """
+        if self.rasterizer != None:
+            self._upload_completed()
+
+        def distance(pos):
+            return abs(pos[0] - focus[0]) + abs(pos[1] - focus[1])
+        visible = set(visible)
+        prefetch = set(prefetch) - visible
+        for pos in list(self._dirty):
+            if pos not in visible and pos not in prefetch:
+                self.discard(pos)
+        tasks = (sorted([pos for pos in self._dirty if pos in visible],
+                        key=distance) +
+                 sorted([pos for pos in prefetch
+                         if pos in self._dirty or pos not in self.cache],
+                        key=distance))
+        renders = []
+        patched = 0
+        for pos in tasks:
+            if self._dirty.get(pos) == None or self.cache.peek(pos) == None:
+                renders.append(pos)
+            elif patched == 0 or time() < deadline:
+                self._patch(pos)
+                patched += 1
+        if self.rasterizer != None:
+            self._submit(renders)
+            return
+        for (i, pos) in enumerate(renders):
+            if (i > 0 or patched > 0) and time() >= deadline:
+                break
+            self._render(pos)
+            self.background_renders += 1
+
+    def _submit(self, tasks):
+        """Submit chunks to the rasterizer as one batch, in order."""
+        for pos in tasks:
+            if self.rasterizer.pending() >= self.max_pending:
+                break
+            version = self._version.get(pos, 0)
+            if self._in_flight.get(pos) == version:
+                continue # already being rendered
+            self.rasterizer.submit(pos, version)
+            self._in_flight[pos] = version
+        self.rasterizer.end_batch()
+
+    def _upload_completed(self):
+        """Copy finished chunks from the rasterizer into the cache."""
+        for (pos, version, upload) in self.rasterizer.completed():
+            current = (version == self._version.get(pos, 0))
+            if self._in_flight.get(pos) == version:
+                # last render submitted, so none are in flight now
+                del self._in_flight[pos]
+                self._version.pop(pos, None)
+            if not current:
+                continue # changed since it was submitted
+            surf = self.cache.peek(pos)
+            if surf == None:
+                surf = self.cache.new_surface()
+            upload(surf)
+            self.cache.put(pos, surf)
+            self._dirty.pop(pos, None)
+            self.updated.add(pos)
+            self.background_renders += 1
+
+    def _patch(self, pos):
+        """Redraw the changed blocks of the chunk at pos in the cache."""
+        self.patch_func(self.cache.peek(pos), pos, list(self._dirty.pop(pos)))
+        self.updated.add(pos)
+        self.patches += 1
+
+    def _render(self, pos):
+        """Render the chunk at pos into the cache and return its surface."""
+        surf = self.cache.peek(pos)
+        if surf == None:
+            surf = self.cache.new_surface()
+        self.draw_func(surf, pos)
+        self.cache.put(pos, surf)
+        self._dirty.pop(pos, None)
+        self.updated.add(pos)
+        return surf
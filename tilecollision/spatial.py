@@ -0,0 +1,80 @@
+from math import floor
+
+
+class ChunkIndex:
+    """Buckets of objects by the chunk of the map their position is in.
+
+    Objects are put in the bucket of a position with move, which must be
+    called again when they move into another chunk. Finding the objects in an
+    area only has to look at the buckets overlapping it, instead of every
+    object in the map.
+    """
+    def __init__(self, chunk_size):
+        """Create an empty index of chunks chunk_size blocks square."""
+        self.chunk_size = chunk_size
+        self._buckets = {} # topleft block of chunk -> set of objects
+        self._chunks = {} # object -> topleft block of its chunk
+
+    def __len__(self):
+        """Return the number of objects in the index."""
+        return len(self._chunks)
+
+    def get_chunk(self, pos):
+        """Return the topleft block of the chunk containing grid pos."""
+        cs = self.chunk_size
+        return (int(floor(pos[0] / cs)) * cs, int(floor(pos[1] / cs)) * cs)
+
+    def move(self, obj, pos):
+        """Put obj in the bucket of grid pos, adding it if it's new."""
+        chunk = self.get_chunk(pos)
+        old_chunk = self._chunks.get(obj)
+        if old_chunk == chunk:
+            return
+        if old_chunk != None:
+            self._remove_from_bucket(obj, old_chunk)
+        self._chunks[obj] = chunk
+        self._buckets.setdefault(chunk, set()).add(obj)
+
+    def remove(self, obj):
+        """Remove obj from the index."""
+        self._remove_from_bucket(obj, self._chunks.pop(obj))
+
+    def _remove_from_bucket(self, obj, chunk):
+        """Remove obj from the bucket of chunk, dropping it if it's empty."""
+        bucket = self._buckets[chunk]
+        bucket.discard(obj)
+        if not bucket:
+            del self._buckets[chunk]
+
+    def get_buckets(self):
+        """Return a list of (chunk, set of objects) for each bucket."""
+        return self._buckets.items()
+
+    def in_rect(self, rect):
+        """Return a list of the objects in buckets overlapping a grid rect.
+
+        rect is an (x, y, w, h) tuple. Objects near the rect but outside it
+        may be included.
+        """
+        (x_min, y_min) = self.get_chunk(rect[:2])
+        (x_max, y_max) = self.get_chunk((rect[0] + rect[2], rect[1] + rect[3]))
+        cs = self.chunk_size
+        num_chunks = ((x_max - x_min) / cs + 1) * ((y_max - y_min) / cs + 1)
+        if num_chunks > len(self._buckets):
+            # fewer buckets than chunks in the rect
+            return [obj for ((x, y), bucket) in self._buckets.iteritems()
+                    if x_min <= x <= x_max and y_min <= y <= y_max
+                    for obj in bucket]
+        objs = []
+        for x in xrange(x_min, x_max + 1, cs):
+            for y in xrange(y_min, y_max + 1, cs):
+                objs.extend(self._buckets.get((x, y), ()))
+        return objs
+
+    def in_radius(self, center, radius):
+        """Return a list of the objects in buckets within radius of center.
+
+        Objects up to a chunk further away may be included.
+        """
+        return self.in_rect((center[0] - radius, center[1] - radius,
+                             2 * radius, 2 * radius))
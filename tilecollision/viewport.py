@@ -0,0 +1,82 @@
+import pygame
+
+
+class Viewport:
+    """A backbuffer of the map around the screen, scrolled as the view moves.
+
+    The backbuffer is bigger than the screen by margin pixels on every side.
+    While the view stays inside it, drawing only copies part of it to the
+    screen. When the view leaves it, its contents are scrolled to recenter it
+    on the view, and only the newly exposed strips are redrawn.
+
+    Positions are in map pixels, which are grid positions times the tile
+    size, rounded to integers so that scrolling doesn't blur anything.
+    draw_func(surf, origin, rect) is called to redraw the rect area of the
+    backbuffer, whose topleft is at map pixel origin.
+    """
+    def __init__(self, margin, draw_func):
+        """Create a viewport with a backbuffer margin in pixels."""
+        self.margin = margin
+        self.draw_func = draw_func
+        self._surf = None # created on first use, at the size of the screen
+        self._origin = None # map pixel at the topleft of the backbuffer
+        self._view = None # map pixel at the topleft of the screen
+        self._dirty = [] # rects of the backbuffer to redraw
+
+        self.pixels_drawn = 0 # pixels redrawn in the backbuffer
+
+    def move(self, surf, view):
+        """Move the view to the map pixel view and return the backbuffer rect.
+
+        surf is the surface the viewport will be drawn to. The rect is in map
+        pixels.
+        """
+        self._view = view
+        (width, height) = surf.get_size()
+        size = (width + 2 * self.margin, height + 2 * self.margin)
+        if self._surf == None or self._surf.get_size() != size:
+            self._surf = pygame.Surface(size, 0, surf)
+            self._origin = (view[0] - self.margin, view[1] - self.margin)
+            self._dirty = [self._surf.get_rect()]
+        elif not self._surf.get_rect().contains(
+                (view[0] - self._origin[0], view[1] - self._origin[1],
+                 width, height)):
+            self._scroll((view[0] - self.margin, view[1] - self.margin))
+        return (self._origin, size)
+
+    def _scroll(self, origin):
+        """Scroll the backbuffer so its topleft is at the map pixel origin."""
+        (dx, dy) = (self._origin[0] - origin[0], self._origin[1] - origin[1])
+        self._origin = origin
+        self._surf.scroll(dx, dy)
+        self._dirty = [rect.move(dx, dy) for rect in self._dirty]
+        (width, height) = self._surf.get_size()
+        # strips uncovered by scrolling
+        if dx > 0:
+            self._dirty.append(pygame.Rect(0, 0, dx, height))
+        elif dx < 0:
+            self._dirty.append(pygame.Rect(width + dx, 0, -dx, height))
+        if dy > 0:
+            self._dirty.append(pygame.Rect(0, 0, width, dy))
+        elif dy < 0:
+            self._dirty.append(pygame.Rect(0, height + dy, width, -dy))
+
+    def invalidate(self, rect):
+        """Mark a rect of map pixels as needing to be redrawn."""
+        rect = pygame.Rect(rect).move(-self._origin[0], -self._origin[1])
+        rect = rect.clip(self._surf.get_rect())
+        if rect:
+            self._dirty.append(rect)
+
+    def draw(self, surf):
+        """Redraw the invalidated parts of the backbuffer and copy to surf."""
+        bounds = self._surf.get_rect()
+        for rect in self._dirty:
+            rect = rect.clip(bounds)
+            if rect:
+                self.draw_func(self._surf, self._origin, rect)
+                self.pixels_drawn += rect.width * rect.height
+        self._dirty = []
+        surf.blit(self._surf, (0, 0), ((self._view[0] - self._origin[0], 
+                                        self._view[1] - self._origin[1]) + 
+                                       surf.get_size()))